@@ -3,6 +3,7 @@ import os
 from flask import Flask
 from flaskext.cache import Cache
 from flaskext.mail import Mail
+from redis import Redis
 
 from breezeminder.util import logger
 from breezeminder.util.mongo import PortAwareMongoEngine
@@ -28,7 +29,11 @@ def get_app():
 app = get_app()
 cache = Cache(app)
 mail = Mail(app)
+redis = Redis(host=app.config.get('REDIS_HOST', 'localhost'),
+              port=app.config.get('REDIS_PORT', 6379),
+              db=app.config.get('REDIS_DB', 0))
 
 # Assign modules to the app
 app.cache = cache
 app.mail = mail
+app.redis = redis
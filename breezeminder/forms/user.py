@@ -23,6 +23,11 @@ YES_NO_CHOICES = [
     ('N', 'No')
 ]
 
+HOUR_CHOICES = [('', 'Default')] + [
+    (str(hour), '%d %s' % (hour % 12 or 12, 'AM' if hour < 12 else 'PM'))
+    for hour in range(24)
+]
+
 
 @app.cache.memoize(timeout=3600)
 def _wireless_providers():
@@ -89,6 +94,14 @@ class ProfileForm(Form):
                                  PhoneNumber(),
                                  Conditional('phone_carrier', '', validators=[required()], not_equals=True)
                               ])
+    quiet_start = SelectField('Quiet Hours From', choices=HOUR_CHOICES,
+                              validators=[
+                                  Conditional('quiet_end', '', validators=[required()], not_equals=True)
+                                ])
+    quiet_end = SelectField('Quiet Hours Until', choices=HOUR_CHOICES,
+                            validators=[
+                                Conditional('quiet_start', '', validators=[required()], not_equals=True)
+                              ])
 
     def __init__(self, *args, **kwargs):
         super(ProfileForm, self).__init__(*args, **kwargs)
@@ -99,6 +112,13 @@ class ProfileForm(Form):
         user.first_name = self.first_name.data
         user.last_name = self.last_name.data
 
+        # Reminders queued during quiet hours are held until they end
+        if self.quiet_start.data and self.quiet_end.data:
+            user.quiet_start = int(self.quiet_start.data)
+            user.quiet_end = int(self.quiet_end.data)
+        else:
+            user.quiet_start = user.quiet_end = None
+
         if self.phone_number.data:
             import re
             from breezeminder.models.user import PhoneNumber
@@ -124,6 +144,10 @@ class ProfileForm(Form):
             'last_name': user.last_name
         }
 
+        if user.quiet_start is not None and user.quiet_end is not None:
+            data['quiet_start'] = str(user.quiet_start)
+            data['quiet_end'] = str(user.quiet_end)
+
         # The phone field
         if user.cell_phone:
             data['phone_type'] = user.cell_phone.type
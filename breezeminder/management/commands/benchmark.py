@@ -0,0 +1,138 @@
+import atexit
+import logging
+import os
+import timeit
+
+from datetime import datetime
+from flask.ext.script import Command, Option
+
+from breezeminder.app import app
+
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                            'lib', 'example_output.html')
+
+
+def bench_parser():
+    """ Balance page parsing with BeautifulSoup vs the single pass extractor """
+    from BeautifulSoup import BeautifulSoup
+    from breezeminder.models.card import BreezeCard
+    from breezeminder.util.balance import parse_balance_page
+
+    with open(EXAMPLE_FILE, 'r') as f:
+        content = f.read()
+
+    card = BreezeCard()
+
+    def soup_parse():
+        soup = BeautifulSoup(content)
+        card._parse_expiration_date(soup)
+        card._parse_stored_value(soup)
+        card._parse_products(soup)
+        card._parse_pending_transactions(soup)
+
+    return [
+        ('BeautifulSoup', soup_parse),
+        ('parse_balance_page', lambda: parse_balance_page(content)),
+    ]
+
+
+def bench_snapshot():
+    """ Capturing card state before a pull with deepcopy vs CardSnapshot """
+    from copy import deepcopy
+    from breezeminder.models.card import (BreezeCard,
+                                          CardSnapshot,
+                                          PendingTransaction,
+                                          Product)
+    from breezeminder.models.user import User
+
+    card = BreezeCard(owner=User(email='foo@bar.com'),
+                      stored_value=12.5,
+                      expiration_date=datetime.now(),
+                      last_loaded=datetime.now())
+    card.set_number('1111222233334444')
+    card.products = [Product(name='Product-%s' % i,
+                             expiration_date=datetime.now(),
+                             remaining_rides=i) for i in range(3)]
+    card.pending = [PendingTransaction(name='Autoload', value=20)]
+
+    return [
+        ('deepcopy', lambda: deepcopy(card)),
+        ('CardSnapshot.from_card', lambda: CardSnapshot.from_card(card)),
+    ]
+
+
+def bench_mail():
+    """ Mail queue delivery, a connection per message vs pooled persistent connections """
+    from flaskext.mail import Mail, Message
+    from breezeminder.util.delivery import MailDelivery
+    from breezeminder.util.testing import LocalSMTPServer
+
+    server = LocalSMTPServer().start()
+    atexit.register(server.stop)
+    mail = server.configure(Mail(app))
+    batch = 20
+
+    messages = [Message(subject='Message %s' % i,
+                        sender='no-reply@breezeminder.com',
+                        recipients=['foo@bar.com'],
+                        body='Bar') for i in range(batch)]
+
+    def connection_per_message():
+        for message in messages:
+            with mail.connect() as conn:
+                conn.send(message)
+
+    def pooled(workers):
+        return lambda: MailDelivery(mail, workers=workers).deliver(enumerate(messages))
+
+    return [
+        ('connection per message', connection_per_message, batch),
+        ('MailDelivery, 1 worker', pooled(1), batch),
+        ('MailDelivery, %s workers' % app.config.get('MAIL_DELIVERY_WORKERS', 2),
+         pooled(app.config.get('MAIL_DELIVERY_WORKERS', 2)), batch),
+    ]
+
+
+BENCHMARKS = {
+    'mail': bench_mail,
+    'parser': bench_parser,
+    'snapshot': bench_snapshot,
+}
+
+
+class Benchmark(Command):
+    """ Times hot code paths against the implementations they replaced """
+
+    def get_options(self):
+        return [
+            Option('name', choices=sorted(BENCHMARKS.keys()),
+                   help='The benchmark to run'),
+            Option('-n', '--number', dest='number', type=int, default=1000,
+                   help='Number of iterations of each candidate'),
+        ]
+
+    def run(self, **kwargs):
+        name = kwargs['name']
+        number = kwargs['number']
+        candidates = BENCHMARKS[name]()
+
+        print '%s: %s' % (name, BENCHMARKS[name].__doc__.strip())
+
+        # Logging would dominate the timings
+        logging.disable(logging.CRITICAL)
+        try:
+            baseline = None
+            for candidate in candidates:
+                # Candidates may handle several items, e.g. messages, per iteration
+                label, fn = candidate[:2]
+                items = candidate[2] if len(candidate) > 2 else 1
+
+                elapsed = timeit.timeit(fn, number=number)
+                baseline = baseline or elapsed
+                print '  %-28s %10.4f ms/iter  %10.1f/s  %6.2fx' % (label,
+                                                                    elapsed * 1000.0 / number,
+                                                                    number * items / elapsed,
+                                                                    baseline / elapsed)
+        finally:
+            logging.disable(logging.NOTSET)
@@ -0,0 +1,16 @@
+from flask.ext.script import Command
+
+from breezeminder.models.messaging import Messaging
+
+
+class FixDeliverAfter(Command):
+    """ Makes unsent messages queued before quiet hours due right away """
+
+    def run(self, **kwargs):
+        print 'Updating unsent Messaging'
+        count = 0
+        for message in Messaging.objects.filter(is_sent=False, deliver_after=None):
+            count += 1
+            message.deliver_after = message.created
+            message.save()
+        print '%d Updated\n' % count
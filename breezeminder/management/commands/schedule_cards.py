@@ -0,0 +1,20 @@
+from flask.ext.script import Command, Option
+
+from breezeminder.models.card import BreezeCard, refresh_queue
+
+
+class ScheduleCards(Command):
+    """ Seeds the card due queue from the database, e.g. after losing redis """
+
+    def get_options(self):
+        return [
+            Option('--chunk', dest='chunk', type=int, default=500,
+                   help='Number of cards to schedule per redis round trip'),
+            Option('--spread', dest='spread', type=int, default=0,
+                   help='Spread cards that are already due over this many minutes')
+        ]
+
+    def run(self, **kwargs):
+        count = BreezeCard.objects.schedule_all(spread=kwargs.get('spread', 0) * 60,
+                                                chunk=kwargs.get('chunk', 500))
+        print '%d cards scheduled. %d due now' % (count, refresh_queue.count_due())
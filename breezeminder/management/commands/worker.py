@@ -0,0 +1,46 @@
+import os
+import socket
+
+from flask.ext.script import Command, Option
+
+from breezeminder.app import app
+
+
+class Worker(Command):
+    """ Runs a celery worker for one queue with that queue's pool settings """
+
+    def get_options(self):
+        return [
+            Option('--pool', dest='pool', default=os.environ.get('BREEZEMINDER_WORKER_POOL'),
+                   help='Queue to consume. One of %s. All queues if omitted' % \
+                           ', '.join(sorted(app.config['CELERY_WORKER_POOLS']))),
+            Option('-B', '--beat', dest='beat', default=False, action='store_true',
+                   help='Also run celerybeat. Only one worker should'),
+            Option('-l', '--loglevel', dest='loglevel', default=None,
+                   help='Log level, defaults to CELERYD_LOG_LEVEL')
+        ]
+
+    def run(self, **kwargs):
+        from celery.app import current_app
+        from celery.bin.celeryd import WorkerCommand
+
+        celery = current_app()
+        pool = kwargs.get('pool')
+        options = {
+            'run_clockservice': kwargs.get('beat', False),
+            'loglevel': kwargs.get('loglevel'),
+        }
+
+        if pool:
+            settings = app.config['CELERY_WORKER_POOLS'].get(pool)
+            if settings is None:
+                print 'Unknown pool %s' % pool
+                return
+
+            # Prefetch is only read from config when the worker starts
+            celery.conf.CELERYD_PREFETCH_MULTIPLIER = settings.get('prefetch', 4)
+            options.update(queues=[pool],
+                           concurrency=settings.get('concurrency'),
+                           hostname='%s.%s' % (pool, socket.gethostname()))
+
+        WorkerCommand(app=celery).run(**options)
@@ -1,14 +1,27 @@
+import hmac
+import random
 import re
 import requests
+import sys
+import time
 
-from BeautifulSoup import BeautifulSoup
-from copy import deepcopy
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
 
 from breezeminder.app import app
 from breezeminder.models.base import (BaseDocument,
                                       BaseQuerySet)
+from breezeminder.util.balance import parse_balance_page
 from breezeminder.util.crypto import encrypt, decrypt
+from breezeminder.util.scheduling import DueQueue, set_once
+from breezeminder.util.throttle import (CircuitBreaker,
+                                        CircuitOpen,
+                                        RedisCircuitBreaker,
+                                        RedisTokenBucket,
+                                        TokenBucket,
+                                        Throttled)
 
 
 BREEZECARD_ENDPOINT = 'https://balance.breezecard.com/breezeWeb/cardnumber_qa.do'
@@ -16,21 +29,213 @@ BREEZECARD_ENDPOINT = 'https://balance.breezecard.com/breezeWeb/cardnumber_qa.do
 _numeric_only_pat = re.compile(r'[^0-9]')
 
 
+class PullInProgress(Exception):
+    """ Raised when another worker is already pulling the same card """
+    pass
+
+
 def format_numeric_number(value):
     return _numeric_only_pat.sub('', value)
 
 
+def _reference_id(document, name):
+    """ The id held by a reference field, without dereferencing it """
+    value = document._data.get(name)
+    return getattr(value, 'id', value)
+
+
+def _release(lock):
+    """
+    Releases a pull lock unless it expired. By then another worker may hold
+    it, and redis-py would delete their lock along with ours
+    """
+    if lock.acquired_until > time.time():
+        lock.release()
+    else:
+        app.logger.warning('Pull lock %s expired before the pull finished' % lock.name)
+
+
+# When each card is next due for a pull. See tasks.check_card_pulls
+refresh_queue = DueQueue(app.redis, 'breezeminder:cards:due')
+
+
+def _make_throttles():
+    """
+    Builds the rate limiter and circuit breaker guarding the breeze card endpoint.
+    Backed by redis they are shared by every worker, 'local' keeps them in process
+    """
+    limit = {
+        'rate': app.config.get('CARD_FETCH_RATE', '10/m'),
+        'capacity': app.config.get('CARD_FETCH_BURST', 1),
+    }
+    breaker = {
+        'window': app.config.get('CARD_BREAKER_WINDOW', 60),
+        'min_calls': app.config.get('CARD_BREAKER_MIN_CALLS', 10),
+        'threshold': app.config.get('CARD_BREAKER_THRESHOLD', 0.5),
+        'slow': app.config.get('CARD_BREAKER_SLOW', 10),
+        'pause': app.config.get('CARD_BREAKER_PAUSE', 300),
+    }
+
+    if app.config.get('CARD_THROTTLE_BACKEND', 'redis') == 'local':
+        return TokenBucket(**limit), CircuitBreaker(**breaker)
+
+    return (RedisTokenBucket(app.redis, 'breezeminder:cards:tokens', **limit),
+            RedisCircuitBreaker(app.redis, 'breezeminder:cards:breaker', **breaker))
+
+
+fetch_limiter, fetch_breaker = _make_throttles()
+
+_session = None
+
+
+def get_session():
+    """
+    Returns the keep-alive session used for talking to the breeze card endpoint.
+    It is created lazily so that each worker process gets its own connection pool
+    """
+    global _session
+
+    if _session is None:
+        _session = requests.session(verify=False,
+                                    config={
+                                        'max_retries': 1,
+                                        'pool_maxsize': app.config.get('CARD_FETCH_CONCURRENCY', 4),
+                                        'store_cookies': False
+                                    })
+    return _session
+
+
 class BreezeCardQuerySet(BaseQuerySet):
     def create_fresh_card(self, number, owner):
-        from breezeminder.tasks import pull_card_data
-
         # Create the card and schedule it to be pulled
         card = BreezeCard(owner=owner, number=_numeric_only_pat.sub('', number))
         card.save()
 
-        pull_card_data.delay(card.id)
+        # Should the first pull fail, the card comes due again after the retry delay.
+        # The first pull goes through the priority lane ahead of routine refreshes
+        card.schedule_refresh(datetime.now() + timedelta(seconds=app.config['CARD_RETRY_DELAY']))
+        card.request_refresh()
         return card
 
+    def schedule_all(self, spread=0, chunk=500):
+        """
+        Puts every card in the refresh queue at its next refresh, e.g. after
+        losing redis. Cards already due are spread over ``spread`` seconds.
+        Writes ``chunk`` cards per redis round trip. Returns the number scheduled
+        """
+        jitter = app.config.get('CARD_REFRESH_JITTER', timedelta(0)).total_seconds()
+        now = datetime.now()
+
+        count = 0
+        pending = {}
+        for card in self.only('id', 'last_loaded', 'refresh_interval'):
+            if card.last_loaded is None:
+                when = now
+            else:
+                when = card.next_refresh + timedelta(seconds=random.uniform(0, jitter))
+
+            if when <= now and spread:
+                when = now + timedelta(seconds=random.uniform(0, spread))
+
+            pending[card.id] = when
+            if len(pending) >= chunk:
+                refresh_queue.schedule_many(pending)
+                count += len(pending)
+                pending = {}
+
+        refresh_queue.schedule_many(pending)
+        return count + len(pending)
+
+    def pull_batch(self, card_ids, check_reminders=False):
+        """
+        Pulls fresh data for many cards at once. Remote fetches run concurrently
+        over the shared keep-alive session, capped at CARD_FETCH_CONCURRENCY.
+        Parsing and saving happen serially in the calling thread. Each card is
+        locked only while it is fetched and saved. Returns a list of card ids
+        that could not be pulled. The cards' claims in the refresh
+        queue are released either way
+        """
+        try:
+            return self._pull_batch(card_ids, check_reminders)
+        finally:
+            refresh_queue.release(*card_ids)
+
+    def _pull_batch(self, card_ids, check_reminders=False):
+        if not fetch_breaker.allow():
+            app.logger.warning('Card fetches are paused. Skipping %s cards' % len(card_ids))
+            return list(card_ids)
+
+        cards = list(self.filter(id__in=card_ids))
+        failed = []
+
+        # Cards deleted since they were scheduled should not come due again
+        missing = set(map(str, card_ids)) - set(str(card.id) for card in cards)
+        if missing:
+            refresh_queue.remove(*missing)
+
+        if not cards:
+            return failed
+
+        # Pull priorities and schedules need each owner's reminders. Load them all at once
+        from breezeminder.models.reminder import Reminder
+        reminders = dict((_reference_id(card, 'owner'), []) for card in cards)
+        for reminder in Reminder.objects.filter(owner__in=reminders.keys()):
+            reminders[_reference_id(reminder, 'owner')].append(reminder)
+
+        def fetch(card):
+            """ Locks and fetches one card. Returns (card, lock, content, error) """
+            # Cards another worker is pulling right now are left to that pull
+            lock = card.pull_lock()
+            if not lock.acquire(blocking=False):
+                app.logger.info('Card %s is already being pulled. Skipping' % card.number_masked)
+                return card, None, None, None
+
+            try:
+                # A pull may have finished since the card was claimed or loaded
+                card.reload()
+                if not card.is_due():
+                    app.logger.info('Card %s was pulled since it came due. Skipping' % card.number_masked)
+                    _release(lock)
+                    return card, None, None, None
+
+                return card, lock, card.fetch_content(), None
+            except Exception, e:
+                return card, lock, None, e
+
+        pool = ThreadPool(min(len(cards), app.config.get('CARD_FETCH_CONCURRENCY', 4)))
+        results = pool.imap_unordered(fetch, cards)
+        try:
+            # Each card is processed as soon as it is fetched, so it's only locked that long
+            for card, lock, content, exc in results:
+                if lock is None:
+                    continue
+
+                try:
+                    if exc is not None:
+                        app.logger.error('Failed to fetch card %s: %s' % (card.number_masked, exc))
+                        failed.append(card.id)
+                        continue
+
+                    card._pull_data(check_reminders=check_reminders, content=content,
+                                    reminders=reminders[_reference_id(card, 'owner')])
+                except Exception:
+                    app.logger.exception('Failed to process card %s' % card.number_masked)
+                    failed.append(card.id)
+                finally:
+                    _release(lock)
+        except:
+            # Let go of cards fetched but never processed
+            exc_info = sys.exc_info()
+            for card, lock, content, exc in results:
+                if lock is not None:
+                    _release(lock)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            pool.close()
+            pool.join()
+
+        return failed
+
 
 class CardDataQuerySet(BaseQuerySet):
     pass
@@ -52,6 +257,10 @@ class BreezeCard(BaseDocument):
     pending = app.db.ListField(app.db.EmbeddedDocumentField('PendingTransaction'))
     last_loaded = app.db.DateTimeField()
     has_data = app.db.BooleanField(required=True, default=False)
+    content_digest = app.db.StringField()
+    last_changed = app.db.DateTimeField()
+    refresh_interval = app.db.IntField()  # seconds. See adapt_refresh_interval
+    pull_priority = app.db.FloatField(default=0.0)
     _shorturl = app.db.StringField()
 
     meta = {
@@ -85,7 +294,9 @@ class BreezeCard(BaseDocument):
 
                 app.logger.debug('Bitly returned data: %s' % data)
                 self._shorturl = data['url']
-                self.save()
+
+                # Only the short url. The card may hold a reminder check's snapshot
+                BreezeCard.objects(id=self.id).update_one(set___shorturl=self._shorturl)
             except:
                 # Log the exception and do not try again for an hour
                 app.logger.exception('An exception occurred contacting bitly')
@@ -104,11 +315,80 @@ class BreezeCard(BaseDocument):
 
     @property
     def next_refresh(self):
+        if self.refresh_interval:
+            return self.last_loaded + timedelta(seconds=self.refresh_interval)
         return self.last_loaded + app.config['REFRESH_INTERVAL']
 
+    def is_due(self, now=None):
+        """ If the card has never been pulled or its next refresh has passed """
+        return self.last_loaded is None or self.next_refresh <= (now or datetime.now())
+
+    def adapt_refresh_interval(self, changed, now=None):
+        """
+        Learns how often this card changes. A pull that finds nothing new backs
+        the interval off by REFRESH_BACKOFF. A change halves it, and brings it
+        under half the time since the previous change. The interval is kept
+        within REFRESH_INTERVAL_MIN and REFRESH_INTERVAL_MAX
+        """
+        now = now or datetime.now()
+        default = app.config['REFRESH_INTERVAL']
+        low = app.config.get('REFRESH_INTERVAL_MIN', default).total_seconds()
+        high = app.config.get('REFRESH_INTERVAL_MAX', default).total_seconds()
+        interval = self.refresh_interval or default.total_seconds()
+
+        if changed:
+            interval /= 2
+            if self.last_changed is not None:
+                interval = min(interval, (now - self.last_changed).total_seconds() / 2)
+            self.last_changed = now
+        else:
+            interval *= app.config.get('REFRESH_BACKOFF', 1.5)
+
+        self.refresh_interval = int(min(max(interval, low), high))
+
+    def update_pull_priority(self, reminders=None):
+        """
+        Sets how close this card is to any of its owner's reminders firing.
+        Due cards with a higher priority are pulled first
+        """
+        if reminders is None:
+            from breezeminder.models.reminder import Reminder
+            reminders = Reminder.objects.filter(owner=_reference_id(self, 'owner'))
+
+        self.pull_priority = max([0.0] + [r.proximity(self) for r in reminders])
+        return self.pull_priority
+
+    def refresh_deadline(self, reminders, now=None):
+        """
+        The start of the next day one of ``reminders`` would fire by the
+        calendar alone, e.g. an expiration reminder. None if there is none.
+        A backed off card must be pulled by then or the reminder is missed
+        """
+        dates = [d for d in (r.next_fire_date(self, now=now) for r in reminders) if d is not None]
+        if not dates:
+            return None
+        return datetime.combine(min(dates), datetime.min.time())
+
+    def schedule_refresh(self, when=None, reminders=None):
+        """
+        Schedules the next pull of this card. Defaults to the next refresh,
+        jittered by up to CARD_REFRESH_JITTER so pulls don't bunch up, but no
+        later than the refresh deadline set by the owner's ``reminders``
+        """
+        if when is None:
+            jitter = app.config.get('CARD_REFRESH_JITTER', timedelta(0))
+            when = self.next_refresh + timedelta(seconds=random.uniform(0, jitter.total_seconds()))
+
+            deadline = self.refresh_deadline(reminders or [])
+            if deadline is not None and deadline < when:
+                when = deadline
+        refresh_queue.schedule(self.id, when)
+
     @property
     def can_refresh(self):
-        if not app.config['REFRESH_LIMITING'] and self.next_refresh < datetime.now():
+        # Users are held to the site wide interval, not the one this card adapted
+        if not app.config['REFRESH_LIMITING'] and \
+                self.last_loaded + app.config['REFRESH_INTERVAL'] < datetime.now():
             return True
         return False
 
@@ -123,32 +403,124 @@ class BreezeCard(BaseDocument):
         else:
             super(BreezeCard, self).__setattr__(attr, value)
 
-    def fetch_remote_data(self):
+    def delete(self, *args, **kwargs):
+        refresh_queue.remove(self.id)
+        super(BreezeCard, self).delete(*args, **kwargs)
+
+    def fetch_remote_data(self, session=None, priority=False):
+        """
+        Fetches the card document. Raises Throttled if the shared rate limit
+        can't be met within CARD_FETCH_WAIT seconds, or CircuitOpen if fetches
+        are paused because the endpoint is failing. Background fetches leave
+        CARD_FETCH_RESERVE tokens for ``priority`` ones, e.g. first pulls
+        """
         app.logger.info('Fetching remote data for card %s' % self.number_masked)
 
+        if not fetch_breaker.allow():
+            raise CircuitOpen('Card fetches are paused')
+
+        reserve = 0 if priority else app.config.get('CARD_FETCH_RESERVE', 0)
+        if not fetch_limiter.acquire(timeout=app.config.get('CARD_FETCH_WAIT', 30), reserve=reserve):
+            raise Throttled('Timed out waiting to fetch card %s' % self.number_masked)
+
         payload = {
             'cardnumber': format_numeric_number(self.number),
             'submitButton.x': '0',
             'submitButton.y': '0'
         }
 
-        # Try to post with retry one time, then fail if error
-        resp = requests.post(BREEZECARD_ENDPOINT, data=payload, verify=False,
-                             config={'max_retries': 1})
+        # Reuse pooled connections. The session retries one time, then fails
+        session = session or get_session()
+
+        def post():
+            resp = session.post(BREEZECARD_ENDPOINT, data=payload,
+                                timeout=app.config.get('CARD_FETCH_TIMEOUT', 20))
+
+            # Server errors count against the breaker
+            if resp.status_code >= 500:
+                raise requests.exceptions.HTTPError('Card fetch returned %s' % resp.status_code)
+            return resp
+
+        resp = fetch_breaker.call(post)
         app.logger.debug('Card fetch for %s returned %s' % (self.number_masked, resp.content.strip()))
 
         return resp.content.strip()
 
-    def pull_data(self, auto_save=True, check_reminders=False):
-        """ Pulls fresh remote data, parses and stores it """
-        now = datetime.now()
-        last_state = deepcopy(self)
-
+    def fetch_content(self, priority=False):
+        """ Fetches the raw card document, or the mock file if configured """
         if app.config.get('MOCK_FETCH', False):
             with open(app.config['MOCK_FILE'], 'r') as f:
-                content = f.read()
-        else:
-            content = self.fetch_remote_data()
+                return f.read()
+        return self.fetch_remote_data(priority=priority)
+
+    @property
+    def pull_lock_key(self):
+        return 'breezeminder:cards:pull:%s' % self.id
+
+    @property
+    def refresh_key(self):
+        return 'breezeminder:cards:refresh:%s' % self.id
+
+    def pull_lock(self):
+        """ Redis lock held for the length of a pull. It expires should the puller die """
+        return app.redis.lock(self.pull_lock_key,
+                              timeout=app.config.get('CARD_PULL_LOCK_TIMEOUT', 120))
+
+    @property
+    def is_refreshing(self):
+        """ True while a requested refresh is queued or any pull of this card is running """
+        if app.redis.exists(self.refresh_key):
+            return True
+
+        # Locks hold the time they expire rather than a redis TTL
+        return float(app.redis.get(self.pull_lock_key) or 0) > time.time()
+
+    def request_refresh(self):
+        """
+        Queues a pull in the priority lane, e.g. when a user asks for one.
+        Returns False if the card is already queued or being pulled, in which
+        case that pull serves this request too
+        """
+        from breezeminder.tasks import pull_card_data
+
+        # Should the task never run, the key expires and the card doesn't look busy forever
+        if self.is_refreshing or not set_once(app.redis, self.refresh_key,
+                                              app.config.get('CARD_REFRESH_TIMEOUT', 5 * 60)):
+            return False
+
+        pull_card_data.delay(self.id, force=True)
+        return True
+
+    def pull_data(self, auto_save=True, check_reminders=False, content=None, priority=False):
+        """
+        Pulls fresh remote data, parses and stores it. If ``content`` is
+        supplied, it is used instead of fetching the card document.
+        ``priority`` pulls may use the fetch tokens held back from background
+        ones. Raises PullInProgress if the card is already being pulled
+        """
+        lock = self.pull_lock()
+        if not lock.acquire(blocking=False):
+            raise PullInProgress('Card %s is already being pulled' % self.number_masked)
+
+        try:
+            self._pull_data(auto_save, check_reminders, content, priority)
+        finally:
+            _release(lock)
+
+    def _pull_data(self, auto_save=True, check_reminders=False, content=None, priority=False,
+                   reminders=None):
+        """
+        See pull_data. The caller holds the pull lock. ``reminders`` are the
+        owner's, if already loaded, for the pull priority and next refresh
+        """
+        now = datetime.now()
+
+        if content is None:
+            content = self.fetch_content(priority=priority)
+
+        if reminders is None and auto_save:
+            from breezeminder.models.reminder import Reminder
+            reminders = list(Reminder.objects.filter(owner=_reference_id(self, 'owner')))
 
         if not self._valid_pull(content):
             # Should store error documents
@@ -156,27 +528,56 @@ class BreezeCard(BaseDocument):
             app.logger.error('Invalid card pull response. See document %s' % invalid.id)
             return
 
+        # Most pulls return exactly what we saw last time. Skip the work
+        digest = self._content_digest(content)
+        if self.has_data and digest == self.content_digest:
+            app.logger.info('Card %s is unchanged since last pull' % self.number_masked)
+            self.last_loaded = datetime.now()
+            self.adapt_refresh_interval(changed=False)
+
+            if auto_save:
+                # Expiration dates get closer even when nothing else changes
+                self.update_pull_priority(reminders)
+                BreezeCard.objects(id=self.id).update_one(set__last_loaded=self.last_loaded,
+                                                          set__refresh_interval=self.refresh_interval,
+                                                          set__pull_priority=self.pull_priority)
+                self.schedule_refresh(reminders=reminders)
+
+                # Expiration reminders depend on the date, not the card data
+                if check_reminders:
+                    self.queue_reminders(types=['EXP'])
+            return
+
+        last_state = CardSnapshot.from_card(self)
+
         # Cache the result FTW!
         data = CardData(card=self, fetch_date=now, document=content)
 
-        # Pull out the parts you need with BeautifulSoup
-        soup = BeautifulSoup(content)
+        # Pull out the parts you need in a single pass
+        parsed = parse_balance_page(content)
+        app.logger.debug('Parsing card %s found %s' % (self.number_masked, parsed))
 
-        # Run the various extractions
-        self.expiration_date = self._parse_expiration_date(soup)
-        self.stored_value = self._parse_stored_value(soup)
+        self.expiration_date = parsed['expiration_date']
+        self.stored_value = parsed['stored_value']
 
         # Get/make the products
         self.products = []
-        for product_data in self._parse_products(soup):
+        for product_data in parsed['products']:
             self.products.append(Product(**product_data))
 
         self.pending = []
-        for pending_data in self._parse_pending_transactions(soup):
+        for pending_data in parsed['pending']:
             self.pending.append(PendingTransaction(**pending_data))
 
+        # The first pull tells us nothing about how often the card changes
+        if self.has_data:
+            self.adapt_refresh_interval(changed=True)
+        else:
+            self.last_changed = now
+
         self.last_loaded = datetime.now()
         self.has_data = True
+        self.content_digest = digest
 
         if auto_save:
             # Remove stale card data
@@ -184,16 +585,33 @@ class BreezeCard(BaseDocument):
                 app.logger.info('Removing stale card data saved on %s' % stale_data.fetch_date)
                 stale_data.delete()
 
+            self.update_pull_priority(reminders)
             self.save()
             data.save()
+            self.schedule_refresh(reminders=reminders)
 
             if check_reminders:
-                self.owner.check_reminders(card=self, last_state=last_state)
+                self.queue_reminders(last_state=last_state)
+
+    def queue_reminders(self, last_state=None, types=None):
+        """
+        Hands reminder checks for this card off to tasks.evaluate_reminders.
+        Pulls only fetch and save. Rendering reminders scales on its own queue
+        """
+        from breezeminder.tasks import evaluate_reminders
+        evaluate_reminders.delay(self.id, last_state, CardSnapshot.from_card(self), types)
+
+    def _content_digest(self, content):
+        """ Keyed digest of a card document. Documents contain the card number """
+        return hmac.new(app.config['SECRET_KEY'], content, sha1).hexdigest()
 
     def _valid_pull(self, content):
         """ Looks for 'enter card serial number' in content """
         return 'enter card serial number' not in content.lower()
 
+    # BeautifulSoup based parsing. pull_data uses parse_balance_page instead,
+    # these are kept as the reference the single pass extractor must match
+
     def _parse_expiration_date(self, soup):
         try:
             found = soup.find('td', text=re.compile(r'your card will expire', re.I))
@@ -297,6 +715,51 @@ class BreezeCard(BaseDocument):
         return pending
 
 
+ProductState = namedtuple('ProductState', ['name', 'expiration_date', 'remaining_rides'])
+PendingState = namedtuple('PendingState', ['name', 'value'])
+
+
+class CardSnapshot(object):
+    """
+    Immutable copy of the card values reminders compare against between pulls.
+    Much cheaper than a deepcopy of the whole card document
+    """
+    __slots__ = ('stored_value', 'expiration_date', 'products', 'pending')
+
+    def __init__(self, stored_value=None, expiration_date=None, products=(), pending=()):
+        set_slot = super(CardSnapshot, self).__setattr__
+        set_slot('stored_value', stored_value)
+        set_slot('expiration_date', expiration_date)
+        set_slot('products', tuple(products))
+        set_slot('pending', tuple(pending))
+
+    @classmethod
+    def from_card(cls, card):
+        products = [ProductState(p.name, p.expiration_date, p.remaining_rides)
+                    for p in card.products or []]
+        pending = [PendingState(p.name, p.value) for p in card.pending or []]
+
+        return cls(card.stored_value, card.expiration_date, products, pending)
+
+    def apply(self, card):
+        """ Sets the snapshot values back on a card, e.g. one loaded after a later pull """
+        card.stored_value = self.stored_value
+        card.expiration_date = self.expiration_date
+        card.products = [Product(**p._asdict()) for p in self.products]
+        card.pending = [PendingTransaction(**p._asdict()) for p in self.pending]
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('CardSnapshot is immutable')
+
+    def __reduce__(self):
+        return (CardSnapshot, (self.stored_value, self.expiration_date,
+                               self.products, self.pending))
+
+    def __repr__(self):
+        return '<CardSnapshot stored_value=%s expiration_date=%s products=%s pending=%s>' % (
+            self.stored_value, self.expiration_date, len(self.products), len(self.pending))
+
+
 class InvalidCardData(BaseDocument):
     """
     A date stored fetch cache for 'bad' or invalid data pulls. Merely for debugging purposes
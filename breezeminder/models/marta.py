@@ -1,5 +1,8 @@
 """MARTA related data classes"""
-from datetime import datetime
+import json
+import uuid
+
+from datetime import datetime, timedelta
 
 from breezeminder.app import app
 from breezeminder.models.base import BaseQuerySet
@@ -255,6 +258,192 @@ class ScheduledStop(app.db.Document):
         return ScheduledStop.timestring_to_seconds(datetime.now().strftime('%H:%M:%S'))
 
 
+class BusQuerySet(BaseQuerySet):
+
+    def persist(self, records):
+        """
+        Writes bus records from :class:`LiveBuses` in one bulk upsert.
+        Returns the number written
+        """
+        if not records:
+            return 0
+
+        bulk = Bus._get_collection().initialize_unordered_bulk_op()
+        for record in records:
+            doc = Bus(**record).to_mongo()
+            bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+        bulk.execute()
+
+        return len(records)
+
+
+class LiveBuses(object):
+    """
+    Current bus positions kept in redis for the realtime task and endpoints.
+    Every bus is in one hash by id, and buses that aren't stale are also in a
+    hash for their route. Buses changed since the last persist are written
+    to mongo by tasks.persist_marta_buses, far less often than each tick.
+    Each route also has a versioned JSON snapshot served as is to browsers
+    """
+
+    FIELDS = ('direction', 'route', 'location', 'adherence',
+              'status_time', 'timepoint', 'stop_id', 'is_stale')
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, redis, prefix):
+        self.redis = redis
+        self.prefix = prefix
+        self.buses_key = '%s:buses' % prefix
+        self.dirty_key = '%s:dirty' % prefix
+        self.snapshots_key = '%s:snapshots' % prefix
+
+    def route_key(self, route):
+        return '%s:route:%s' % (self.prefix, route)
+
+    def snapshot_key(self, route):
+        return '%s:snapshot:%s' % (self.prefix, route)
+
+    def _dumps(self, record):
+        data = dict(record)
+        data['location'] = list(data['location'])
+        data['status_time'] = data['status_time'].strftime(self.TIME_FORMAT)
+        return json.dumps(data)
+
+    def _loads(self, value):
+        data = json.loads(value)
+        data['status_time'] = datetime.strptime(data['status_time'], self.TIME_FORMAT)
+        return data
+
+    def all(self):
+        """ Every bus record, stale or not, by id """
+        return dict((bus_id, self._loads(value))
+                    for bus_id, value in self.redis.hgetall(self.buses_key).iteritems())
+
+    def for_route(self, route):
+        """ Records of buses on a route that aren't stale """
+        return [self._loads(value) for value in self.redis.hgetall(self.route_key(route)).itervalues()]
+
+    def sync(self, feed):
+        """
+        Applies a realtime feed, a list of dicts of Bus fields and its id, in
+        one read and one pipelined write. Buses missing from the feed go
+        stale. Returns the new or changed records and the records of buses
+        that left a route, either by going stale or by moving to another route.
+        The latter are as they were before moving
+        """
+        current = self.all()
+
+        # A vehicle reported twice only counts once, with its latest report
+        latest = {}
+        for record in feed:
+            seen = latest.get(record['id'])
+            if seen is None or record['status_time'] > seen['status_time']:
+                latest[record['id']] = record
+
+        changed = []
+        stale = set(bus_id for bus_id, record in current.iteritems() if not record.get('is_stale'))
+
+        for bus_id, record in latest.iteritems():
+            record = dict(record, location=list(record['location']))
+            existing = current.get(bus_id)
+
+            if existing is not None:
+                stale.discard(bus_id)
+
+                # Older reports than what we have are ignored
+                if record['status_time'] <= existing['status_time']:
+                    continue
+                if all(record.get(name) == existing.get(name) for name in self.FIELDS):
+                    continue
+
+            changed.append(record)
+
+        if not changed and not stale:
+            return changed, []
+
+        departed = []
+        pipe = self.redis.pipeline()
+        for record in changed:
+            value = self._dumps(record)
+            pipe.hset(self.buses_key, record['id'], value)
+            pipe.hset(self.route_key(record['route']), record['id'], value)
+
+            existing = current.get(record['id'])
+            if existing is not None and existing['route'] != record['route']:
+                pipe.hdel(self.route_key(existing['route']), record['id'])
+                departed.append(existing)
+
+        for bus_id in stale:
+            record = dict(current[bus_id], is_stale=True)
+            pipe.hset(self.buses_key, bus_id, self._dumps(record))
+            pipe.hdel(self.route_key(record['route']), bus_id)
+            departed.append(record)
+
+        pipe.sadd(self.dirty_key, *([record['id'] for record in changed] + list(stale)))
+        pipe.execute()
+
+        return changed, departed
+
+    def build_snapshots(self, since):
+        """
+        Serializes the buses on each route reported since ``since`` into one
+        JSON list. A route's version goes up only when its JSON changes.
+        Returns the routes that changed
+        """
+        routes = dict((route, []) for route in self.redis.smembers(self.snapshots_key))
+        for record in self.all().itervalues():
+            if not record.get('is_stale') and record['status_time'] >= since:
+                routes.setdefault(record['route'], []).append(record)
+
+        names = sorted(routes)
+        pipe = self.redis.pipeline(transaction=False)
+        for route in names:
+            pipe.hget(self.snapshot_key(route), 'data')
+        current = pipe.execute()
+
+        updated = []
+        pipe = self.redis.pipeline()
+        for route, existing in zip(names, current):
+            buses = sorted(routes[route], key=lambda record: record['id'])
+            data = json.dumps([Bus(**record).to_json() for record in buses], sort_keys=True)
+            if data == existing:
+                continue
+
+            # Versions restart should redis lose the snapshot. The generation doesn't repeat
+            pipe.hsetnx(self.snapshot_key(route), 'generation', uuid.uuid4().hex)
+            pipe.hset(self.snapshot_key(route), 'data', data)
+            pipe.hincrby(self.snapshot_key(route), 'version', 1)
+            updated.append(route)
+
+        if updated:
+            pipe.sadd(self.snapshots_key, *updated)
+            pipe.execute()
+
+        return updated
+
+    def snapshot(self, route):
+        """
+        The (version, JSON) snapshot of a route. Versions are strings of the
+        snapshot's generation and count. Before the first it is None
+        """
+        generation, version, data = self.redis.hmget(self.snapshot_key(route),
+                                                     ['generation', 'version', 'data'])
+        if data is None:
+            return None, '[]'
+        return '%s.%s' % (generation, version), data
+
+    def take_dirty(self):
+        """ Records of buses changed since the last call """
+        pipe = self.redis.pipeline()
+        pipe.smembers(self.dirty_key)
+        pipe.delete(self.dirty_key)
+        bus_ids = list(pipe.execute()[0])
+
+        if not bus_ids:
+            return []
+        return [self._loads(value) for value in self.redis.hmget(self.buses_key, bus_ids) if value]
+
+
 class Bus(app.db.Document):
     id = app.db.StringField(primary_key=True)
     direction = app.db.StringField(required=True)
@@ -268,7 +457,7 @@ class Bus(app.db.Document):
 
     meta = {
         'collection': 'marta_bus',
-        'queryset_class': BaseQuerySet,
+        'queryset_class': BusQuerySet,
         'indexes': ['route', 'is_stale']
     }
 
@@ -292,3 +481,120 @@ class Bus(app.db.Document):
             'adherence': self.adherence,
             'time_since': timesince(self.status_time)
         }
+
+
+class BusHistoryQuerySet(BaseQuerySet):
+
+    def append(self, records, days=None):
+        """
+        Appends bus records from :class:`LiveBuses` to their hourly buckets
+        in one bulk upsert. Buckets expire ``days`` after their hour, by
+        default MARTA_HISTORY_DAYS. Returns the number appended
+        """
+        if not records:
+            return 0
+
+        if days is None:
+            days = app.config.get('MARTA_HISTORY_DAYS', 30)
+
+        bulk = BusHistory._get_collection().initialize_unordered_bulk_op()
+        for record in records:
+            hour = BusHistory.hour_of(record['status_time'])
+            lat, lon = record['location']
+
+            bulk.find({'_id': BusHistory.bucket_id(record['id'], record['route'], hour)}).upsert().update_one({
+                '$setOnInsert': {
+                    'bus_id': record['id'],
+                    'route': record['route'],
+                    'hour': hour,
+                    'expires': hour + timedelta(days=days),
+                },
+                '$push': {
+                    't': (record['status_time'] - hour).seconds,
+                    'lat': lat,
+                    'lon': lon,
+                    'adherence': record.get('adherence', 0),
+                }
+            })
+        bulk.execute()
+
+        return len(records)
+
+    def between(self, start, end):
+        """ Buckets with positions from ``start`` up to ``end`` """
+        return self.filter(hour__gte=BusHistory.hour_of(start), hour__lte=end)
+
+    def for_route(self, route, start, end):
+        return self.between(start, end).filter(route=route)
+
+    def for_bus(self, bus_id, start, end):
+        return self.between(start, end).filter(bus_id=bus_id)
+
+    def positions(self, start, end):
+        """
+        Unpacks matching buckets into position dicts between ``start`` and
+        ``end``, ordered by time. Use after for_route or for_bus
+        """
+        positions = []
+        for bucket in self.between(start, end):
+            positions.extend(bucket.positions(start, end))
+        return sorted(positions, key=lambda position: position['status_time'])
+
+
+class BusHistory(app.db.Document):
+    """
+    Past bus positions. Rather than a document per report, each vehicle gets
+    one bucket per route per hour holding its reports as parallel arrays of
+    seconds into the hour, latitude, longitude and adherence. Buckets are
+    removed by a TTL index once they expire
+    """
+    id = app.db.StringField(primary_key=True)
+    bus_id = app.db.StringField(required=True)
+    route = app.db.StringField(required=True)
+    hour = app.db.DateTimeField(required=True)
+    expires = app.db.DateTimeField(required=True)
+    t = app.db.ListField(app.db.IntField())
+    lat = app.db.ListField(app.db.FloatField())
+    lon = app.db.ListField(app.db.FloatField())
+    adherence = app.db.ListField(app.db.IntField())
+
+    meta = {
+        'collection': 'marta_bus_history',
+        'queryset_class': BusHistoryQuerySet,
+        'indexes': [
+            ('route', 'hour'),
+            ('bus_id', 'hour'),
+            {'fields': ['expires'], 'expireAfterSeconds': 0}
+        ]
+    }
+
+    @staticmethod
+    def hour_of(when):
+        return when.replace(minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def bucket_id(bus_id, route, hour):
+        return '%s:%s:%s' % (bus_id, route, hour.strftime('%Y%m%d%H'))
+
+    def positions(self, start=None, end=None):
+        """ Position dicts in this bucket, optionally limited to between ``start`` and ``end`` """
+        positions = []
+        for t, lat, lon, adherence in zip(self.t, self.lat, self.lon, self.adherence):
+            status_time = self.hour + timedelta(seconds=t)
+            if start is not None and status_time < start:
+                continue
+            if end is not None and status_time > end:
+                continue
+
+            positions.append({
+                'id': self.bus_id,
+                'route': self.route,
+                'location': [lat, lon],
+                'adherence': adherence,
+                'status_time': status_time
+            })
+        return positions
+
+
+# Live positions. See tasks.pull_marta_realtime_data
+live_buses = LiveBuses(app.redis, 'breezeminder:marta')
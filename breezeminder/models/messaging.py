@@ -1,12 +1,116 @@
+import re
+
+from datetime import datetime, timedelta
 from flaskext.mail import Message
+from mongoengine.queryset import Q
+from uuid import uuid4
 
 from breezeminder.app import app
 from breezeminder.models.base import (BaseDocument,
                                       BaseQuerySet)
 
 
+_digest_content_pat = re.compile(r'<!-- content -->(.*)<!-- /content -->', re.S)
+
+
+def coalesce(messages, window):
+    """
+    Groups messages that allow digests by recipients and format. A group
+    holds messages created within ``window`` of its first. Returns a list of
+    groups, each a list of messages, in the order they were created
+    """
+    groups = []
+    open_groups = {}
+
+    for message in sorted(messages, key=lambda m: m.created):
+        if not message.allow_digest:
+            groups.append([message])
+            continue
+
+        key = (tuple(sorted(message.recipients)), message.is_plain)
+        group = open_groups.get(key)
+
+        if group is None or message.created - group[0].created > window:
+            group = open_groups[key] = []
+            groups.append(group)
+        group.append(message)
+
+    return groups
+
+
 class MessagingQuerySet(BaseQuerySet):
-    pass
+
+    def _unleased(self, now):
+        return Q(lease_expires=None) | Q(lease_expires__lt=now)
+
+    def claim(self, immediate=False, batch=100, lease=None):
+        """
+        Leases up to ``batch`` unsent messages that are due, oldest first, so
+        that no other worker sends them. Leases expire after ``lease`` seconds,
+        which is how messages held by a crashed worker are sent eventually.
+        Returns the lease token and the claimed messages
+        """
+        now = datetime.now()
+        lease = lease or app.config.get('MAIL_LEASE', 10 * 60)
+        token = uuid4().hex
+
+        # A range over the (is_sent, is_immediate, deliver_after) index. Mail
+        # held for quiet hours is never looked at until it comes due
+        unleased = self.filter(self._unleased(now),
+                               is_sent=False,
+                               is_immediate=immediate,
+                               deliver_after__lte=now)
+        candidates = list(unleased.order_by('deliver_after')[:batch].values_list('id'))
+
+        # Each document is updated atomically, so only one worker can win
+        # a message. Anything taken between the two queries is skipped
+        if candidates:
+            unleased.filter(id__in=candidates).update(set__lease_owner=token,
+                                                      set__lease_expires=now + timedelta(seconds=lease))
+
+        return token, list(self.filter(lease_owner=token).order_by('created'))
+
+    def release(self, token, sent=()):
+        """ Marks ``sent`` messages as sent and hands the rest of a lease back """
+        now = datetime.now()
+        if sent:
+            self.filter(lease_owner=token, id__in=list(sent)).update(set__is_sent=True,
+                                                                     set__updated=now)
+        self.filter(lease_owner=token).update(unset__lease_owner=True,
+                                              unset__lease_expires=True,
+                                              set__updated=now)
+
+    def deliver_pending(self, immediate=False, batch=100):
+        """
+        Leases up to ``batch`` unsent messages and sends them over a pool of
+        MAIL_DELIVERY_WORKERS persistent SMTP connections. Any number of
+        workers can run this at once. Returns the number sent
+        """
+        from breezeminder.util.delivery import MailDelivery
+
+        token, messages = self.claim(immediate=immediate, batch=batch)
+        if not messages:
+            return 0
+
+        # Queued messages for the same recipient go out as one digest
+        window = app.config.get('MAIL_DIGEST_WINDOW')
+        if immediate or not window:
+            groups = [[message] for message in messages]
+        else:
+            groups = coalesce(messages, window)
+
+        sent = []
+        try:
+            outgoing = []
+            for group in groups:
+                message = group[0] if len(group) == 1 else Messaging.digest(group)
+                outgoing.append((tuple(m.id for m in group), message.build_message()))
+
+            delivery = MailDelivery(app.mail, workers=app.config.get('MAIL_DELIVERY_WORKERS', 1))
+            sent = [message_id for ids in delivery.deliver(outgoing) for message_id in ids]
+        finally:
+            self.release(token, sent)
+        return len(sent)
 
 
 class Messaging(BaseDocument):
@@ -22,13 +126,18 @@ class Messaging(BaseDocument):
     is_plain = app.db.BooleanField(required=True, default=False)
     is_sent = app.db.BooleanField(required=True, default=False)
     is_immediate = app.db.BooleanField(required=True, default=False)
+    allow_digest = app.db.BooleanField(required=True, default=False)
+    deliver_after = app.db.DateTimeField(required=True, default=datetime.now)
+    lease_owner = app.db.StringField()
+    lease_expires = app.db.DateTimeField()
 
     meta = {
         'collection': 'messaging',
         'queryset_class': MessagingQuerySet,
         'indexes': [
-            ('is_sent', 'is_immediate'),
-            'created'
+            ('is_sent', 'is_immediate', 'deliver_after'),
+            'created',
+            'lease_owner'
         ]
     }
 
@@ -40,8 +149,46 @@ class Messaging(BaseDocument):
             masked.append('@'.join([masked_addr, domain]))
         return masked
 
-    def send(self, conn=None):
-        """ Sends a message and marks it as sent """
+    @property
+    def digest_content(self):
+        """ The part of the message that goes in a digest. HTML loses its letterhead and signature """
+        if not self.is_plain:
+            match = _digest_content_pat.search(self.message)
+            if match:
+                return match.group(1).strip()
+        return self.message
+
+    @classmethod
+    def digest(cls, messages):
+        """ A single unsaved message combining several for the same recipients """
+        from flask import render_template
+        from breezeminder.app import context, filters
+
+        first = messages[0]
+        parts = [{'subject': m.subject, 'content': m.digest_content} for m in messages]
+
+        if first.is_plain:
+            template = 'messages/sms/digest.html'
+            subject = '%s REMINDERS' % len(messages)
+        else:
+            template = 'messages/email/digest.html'
+            subject = '[BreezeMinder] %s reminders' % len(messages)
+
+        with app.test_request_context():
+            content = render_template(template, parts=parts)
+
+        if first.is_plain:
+            # Make mobile friendly by removing excess whitespace
+            content = re.sub('\s{2,}', ' ', content).strip()
+
+        return cls(recipients=first.recipients,
+                   sender=first.sender,
+                   subject=subject,
+                   message=content,
+                   is_plain=first.is_plain)
+
+    def build_message(self):
+        """ The :class:`flaskext.mail.Message` to send for this message """
         msg = Message(recipients=self.recipients,
                       sender=self.sender,
                       subject=self.subject)
@@ -58,6 +205,11 @@ class Messaging(BaseDocument):
         app.logger.debug('Sending mail to %s: %s\n%s' % (masked_recipients,
                                                          self.subject,
                                                          self.message))
+        return msg
+
+    def send(self, conn=None):
+        """ Sends a message and marks it as sent """
+        msg = self.build_message()
 
         if conn is None:
             with app.mail.connect() as conn:
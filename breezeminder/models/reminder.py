@@ -1,10 +1,13 @@
 import re
-from datetime import datetime
+import time
+
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 from breezeminder.app import app
 from breezeminder.models.base import (BaseDocument,
                                       BaseQuerySet)
+from breezeminder.util.scheduling import set_once
 
 
 class ReminderQuerySet(BaseQuerySet):
@@ -51,8 +54,63 @@ class ReminderType(BaseDocument):
     def __eq__(self, obj):
         if isinstance(obj, basestring):
             return self.key == obj
-        else:
-            return self == obj
+        elif isinstance(obj, ReminderType):
+            return self.id == obj.id and self.key == obj.key
+        return NotImplemented
+
+    def __ne__(self, obj):
+        result = self.__eq__(obj)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+class ReminderTypeRegistry(object):
+    """
+    Every :class:`ReminderType`, loaded once per process. There are only a
+    handful and they rarely change, so they are reloaded after
+    REMINDER_TYPE_TTL seconds, or sooner when asked for one we haven't seen.
+    Each load swaps in new lookups rather than changing them, and the types
+    handed out are shared, so never modify them
+    """
+
+    # Don't reload more often than this when asked for unknown types
+    MISS_RELOAD_INTERVAL = 60
+
+    def __init__(self):
+        self._lookups = ({}, {})
+        self._loaded = None
+
+    def _load(self):
+        types = list(ReminderType.objects.all())
+        self._lookups = (dict((t.id, t) for t in types),
+                         dict((t.key, t) for t in types))
+        self._loaded = time.time()
+
+    def _lookup(self, index, value):
+        age = None if self._loaded is None else time.time() - self._loaded
+
+        if age is None or age > app.config.get('REMINDER_TYPE_TTL', 3600):
+            self._load()
+        elif value not in self._lookups[index] and age > self.MISS_RELOAD_INTERVAL:
+            self._load()
+
+        try:
+            return self._lookups[index][value]
+        except KeyError:
+            raise ReminderType.DoesNotExist('ReminderType %s does not exist' % value)
+
+    def get(self, id):
+        return self._lookup(0, id)
+
+    def get_by_key(self, key):
+        return self._lookup(1, key)
+
+    def reload(self):
+        self._load()
+
+
+reminder_types = ReminderTypeRegistry()
 
 
 class Reminder(BaseDocument):
@@ -73,9 +131,27 @@ class Reminder(BaseDocument):
 
     def __init__(self, **kwargs):
         if 'type' in kwargs and isinstance(kwargs['type'], basestring):
-            kwargs['type'] = ReminderType.objects.get(key=kwargs['type'])
+            kwargs['type'] = reminder_types.get_by_key(kwargs['type'])
         super(Reminder, self).__init__(**kwargs)
 
+    @property
+    def reminder_type(self):
+        """ The :class:`ReminderType` from the registry. Never dereferences ``type`` """
+        value = self._data.get('type')
+        if value is None or isinstance(value, ReminderType):
+            return value
+
+        # An unloaded reference is a DBRef
+        try:
+            return reminder_types.get(getattr(value, 'id', value))
+        except ReminderType.DoesNotExist:
+            return None
+
+    @property
+    def type_key(self):
+        reminder_type = self.reminder_type
+        return reminder_type.key if reminder_type is not None else None
+
     def last_reminded(self, card=None):
         """
         Grabs the last reminder. Proxy for `ReminderHistory.objects.last_reminder`.
@@ -106,14 +182,16 @@ class Reminder(BaseDocument):
             Remaining Rides falls below 3
             Expiration Date is 2 days away
         """
-        if self.type == 'EXP':
+        type_key = self.type_key
+
+        if type_key == 'EXP':
             action = 'is'
             quantity = '%i %s away' % (int(self.threshold), self.quantifier)
-        elif self.type.key.startswith('AVAIL_'):
+        elif type_key.startswith('AVAIL_'):
             action = ''
             quantity = ''
         else:
-            fmt = '$%.2f' if self.type == 'BAL' else '%s'
+            fmt = '$%.2f' if type_key == 'BAL' else '%s'
             action = 'falls below'
             quantity = fmt % self.threshold
 
@@ -122,34 +200,105 @@ class Reminder(BaseDocument):
         else:
             format = '%s %s %s'
 
-        return format % (self.type.name, action, quantity)
+        return format % (self.reminder_type.name, action, quantity)
+
+    def proximity(self, card, now=None):
+        """
+        How close ``card`` is to triggering this reminder, from 0.0 (nowhere
+        near) to 1.0 (at or past the threshold). Used to pull cards that are
+        about to need a reminder ahead of the rest
+        """
+        now = now or datetime.now()
+
+        if self.valid_until and now >= self.valid_until:
+            return 0.0
+
+        type_key = self.type_key
+
+        try:
+            if type_key == 'BAL':
+                return self._threshold_proximity(card.stored_value, self.threshold)
+            elif type_key in ('RIDE', 'ROUND_TRIP'):
+                divisor = 2.0 if type_key == 'ROUND_TRIP' else 1.0
+                return max([0.0] + [self._threshold_proximity(p.remaining_rides / divisor, self.threshold)
+                                    for p in card.products if p.remaining_rides is not None])
+            elif type_key == 'EXP':
+                dates = [card.expiration_date] + [p.expiration_date for p in card.products]
+                return max([0.0] + [self._date_proximity(d, now) for d in dates if d is not None])
+            elif type_key in ('AVAIL_BAL', 'AVAIL_PROD'):
+                # Pending autoloads are what becomes available next
+                return 1.0 if card.pending else 0.0
+        except (TypeError, ValueError, NotImplementedError):
+            app.logger.exception('Could not compute %s reminder proximity' % type_key)
+
+        return 0.0
+
+    def _threshold_proximity(self, value, threshold):
+        """ Ratio of threshold to value. Reminders fire once value falls to threshold """
+        if value is None:
+            return 0.0
+
+        value, threshold = float(value), float(threshold)
+        if value <= threshold:
+            return 1.0
+        return threshold / value
+
+    def _date_proximity(self, exp_date, now):
+        """ Decays with the number of days until the reminder would fire """
+        days = (exp_date.date() - self._exp_delta() - now.date()).days
+        if days < 0:
+            return 0.0
+        return 1.0 / (1 + days)
+
+    def next_fire_date(self, card, now=None):
+        """
+        The next day after ``now`` this reminder would fire for ``card`` by the
+        calendar alone, or None. Only expiration reminders fire on a date. The
+        others fire on changes found by a pull
+        """
+        now = now or datetime.now()
+
+        if self.type_key != 'EXP' or (self.valid_until and now >= self.valid_until):
+            return None
+
+        try:
+            delta = self._exp_delta()
+        except NotImplementedError:
+            return None
+
+        fires = []
+        for exp_date in [card.expiration_date] + [p.expiration_date for p in card.products]:
+            if exp_date is None:
+                continue
+
+            # Month lengths vary, so days near exp_date - delta may also land on it
+            guess = exp_date.date() - delta
+            for offset in range(-3, 4):
+                day = guess + timedelta(days=offset)
+                if day > now.date() and day + delta == exp_date.date():
+                    fires.append(day)
+
+        return min(fires) if fires else None
 
     def check_reminder(self, card, last_state=None):
-        """ Entry point for lazily checking reminders based on type """
+        """
+        Entry point for lazily checking reminders based on type. ``last_state``
+        is a :class:`CardSnapshot` of the card as it was before the latest pull
+        """
 
         # Don't proceed if we've passed the time we are limiting to
         if self.valid_until and datetime.now() >= self.valid_until:
             return False
 
-        if self.type == 'BAL':
-            return self._check_balance_reminder(card, last_state)
-        elif self.type == 'RIDE':
-            return self._check_ride_reminder(card, last_state)
-        elif self.type == 'ROUND_TRIP':
-            return self._check_round_trip_reminder(card, last_state)
-        elif self.type == 'EXP':
-            return self._check_expiration_reminder(card)
-        elif self.type == 'AVAIL_BAL':
-            if last_state:
-                return self._check_available_balance_reminder(card, last_state)
-        elif self.type == 'AVAIL_PROD':
-            if last_state:
-                return self._check_available_product_reminder(card, last_state)
-        else:
-            message = 'Reminders for type %s are not implemented' % self.type
+        try:
+            check = REMINDER_CHECKS[self.type_key]
+        except KeyError:
+            message = 'Reminders for type %s are not implemented' % self.type_key
             app.logger.exception(message)
             raise NotImplementedError(message)
 
+        return check(self, card, last_state)
+
     def _check_available_balance_reminder(self, card, last_state):
         """ Check if card stored value has increased """
         if card.stored_value is not None and last_state.stored_value is not None:
@@ -310,97 +459,225 @@ class Reminder(BaseDocument):
 
     def check_all_cards(self, force=False):
         from breezeminder.models.card import BreezeCard
-        for card in BreezeCard.objects.filter(owner=self.owner):
-            self.remind(card, force=force)
+        ReminderEngine(self.owner, reminders=[self]).run(BreezeCard.objects.filter(owner=self.owner),
+                                                         force=force)
+
+    @staticmethod
+    def check_key_for(reminder_id):
+        return 'breezeminder:reminders:check:%s' % reminder_id
+
+    @property
+    def check_key(self):
+        return Reminder.check_key_for(self.id)
+
+    def queue_check_all_cards(self, delay=None):
+        """
+        Checks every card in the background after ``delay`` seconds. Calls
+        made before that check starts collapse into it. Returns True if a new
+        check was queued
+        """
+        from breezeminder.tasks import check_reminder_cards
+
+        if delay is None:
+            delay = app.config.get('REMINDER_CHECK_DELAY', 30)
+
+        # Should the task never run, the key still goes away
+        if not set_once(app.redis, self.check_key,
+                        delay + app.config.get('REMINDER_CHECK_TIMEOUT', 10 * 60)):
+            return False
+
+        check_reminder_cards.apply_async(args=[self.id], countdown=delay)
+        return True
 
     def remind(self, card, force=False, last_state=None):
-        # Get last reminded for card
-        last_reminder_sent = self.last_reminded(card)
-        if not force and last_reminder_sent and (datetime.now() - last_reminder_sent.sent_date).days < 1:
-            # Don't proceed if we've already sent out a reminder today
-            app.logger.info('%s Reminder for card %s has already been sent today. Last sent: %s' % (self.type,
-                                                                                                    card.last_four,
-                                                                                                    last_reminder_sent))
-            return
+        ReminderEngine(self.owner, reminders=[self]).run([card], force=force, last_state=last_state)
+
 
-        app.logger.info('Begin %s reminder check for %s' % (self.type, card.last_four))
+def _needs_last_state(check):
+    """ Some checks compare against the card as it was before the pull """
+    def checker(reminder, card, last_state=None):
+        if last_state:
+            return check(reminder, card, last_state)
+        return False
+    return checker
+
+
+# Reminder type key -> check(reminder, card, last_state)
+REMINDER_CHECKS = {
+    'BAL': Reminder._check_balance_reminder,
+    'RIDE': Reminder._check_ride_reminder,
+    'ROUND_TRIP': Reminder._check_round_trip_reminder,
+    'EXP': lambda reminder, card, last_state=None: reminder._check_expiration_reminder(card),
+    'AVAIL_BAL': _needs_last_state(Reminder._check_available_balance_reminder),
+    'AVAIL_PROD': _needs_last_state(Reminder._check_available_product_reminder),
+}
+
+
+class ReminderEngine(object):
+    """
+    Checks cards against an owner's reminders with a fixed number of queries,
+    however many cards and reminders there are. Reminders and their types are
+    loaded once, as is the owner's reminder history for the past day. Checks
+    run in memory, and new messages and history are inserted in bulk
+    """
+
+    def __init__(self, owner, reminders=None):
+        self.owner = owner
+
+        if reminders is None:
+            reminders = Reminder.objects.filter(owner=owner)
+        self.reminders = list(reminders)
+        self._recent = None
+
+    def recently_reminded(self, reminder, card):
+        """ If a reminder was sent for this card in the past day """
+        if self._recent is None:
+            self._recent = self._load_recent()
+        return (reminder.id, card.id) in self._recent
+
+    def _load_recent(self):
+        """ Set of (reminder id, card id) reminded in the past day, in a single query """
+        since = datetime.now() - timedelta(days=1)
+        cursor = ReminderHistory._get_collection().find({'owner': self.owner.id,
+                                                         'sent_date': {'$gt': since}},
+                                                        fields=['reminder', 'card'])
+
+        # Old documents may still hold DBRefs
+        return set((getattr(doc['reminder'], 'id', doc['reminder']),
+                    getattr(doc['card'], 'id', doc['card'])) for doc in cursor)
+
+    def run(self, cards, force=False, last_state=None, types=None):
+        """
+        Checks every card against every reminder, optionally limited to a list
+        of reminder type keys. Returns the number of reminders sent
+        """
+        messages = []
+        history = []
+
+        for card in cards:
+            for reminder in self.reminders:
+                if types is not None and reminder.type_key not in types:
+                    continue
 
-        if not self.check_reminder(card, last_state=last_state):
-            app.logger.info('Card %s does not need a %s reminder' % (card.last_four, self.type))
-            return
+                if not force and self.recently_reminded(reminder, card):
+                    # Don't proceed if we've already sent out a reminder today
+                    app.logger.info('%s Reminder for card %s has already been sent today' % (reminder.type_key,
+                                                                                           card.last_four))
+                    continue
 
+                app.logger.info('Begin %s reminder check for %s' % (reminder.type_key, card.last_four))
+
+                if not reminder.check_reminder(card, last_state=last_state):
+                    app.logger.info('Card %s does not need a %s reminder' % (card.last_four, reminder.type_key))
+                    continue
+
+                app.logger.info('Reminding user %s of %s at or below threshold' % (self.owner.id, reminder.type_key))
+                reminder_messages, record = self.compose(reminder, card, last_state)
+                messages.extend(reminder_messages)
+                if record is not None:
+                    history.append(record)
+
+                if self._recent is not None:
+                    self._recent.add((reminder.id, card.id))
+
+        from breezeminder.models.messaging import Messaging
+        self._insert(Messaging, messages)
+
+        # Record History, but don't bring down the house
+        try:
+            self._insert(ReminderHistory, history)
+        except:
+            app.logger.exception('Could not save reminder history objects')
+
+        return len(history)
+
+    def _insert(self, document, docs):
+        """ Bulk insert. This skips save(), so timestamps are set here """
+        if docs:
+            now = datetime.now()
+            for doc in docs:
+                doc.created = doc.updated = now
+            document.objects.insert(docs, load_bulk=False)
+
+    def compose(self, reminder, card, last_state=None):
+        """
+        Renders the messages and history for a reminder without saving them.
+        Returns a list of :class:`Messaging` and a :class:`ReminderHistory`,
+        which is None if the web message could not be rendered
+        """
         from flask import render_template
         from breezeminder.app import context, filters
         from breezeminder.models.messaging import Messaging
 
-        app.logger.info('Reminding user %s of %s at or below threshold' % (self.owner.id, self.type))
+        type_name = reminder.reminder_type.name
+        type_key = reminder.type_key.lower()
 
-        subject = '[BreezeMinder] %s reminder' % self.type.name
+        subject = '[BreezeMinder] %s reminder' % type_name
         messages = []
         context = {
             'card': card,
-            'reminder': self,
+            'reminder': reminder,
             'last_state': last_state
         }
 
         # Build list of expiring content
-        if self.type == 'EXP':
-            delta = self._exp_delta()
+        if type_key == 'exp':
+            delta = reminder._exp_delta()
             expiring = {
-                'card': self._will_expire(card.expiration_date, delta)
+                'card': reminder._will_expire(card.expiration_date, delta)
             }
 
-            expiring['products'] = [ p for p in card.products if self._will_expire(p.expiration_date, delta) ]
+            expiring['products'] = [ p for p in card.products if reminder._will_expire(p.expiration_date, delta) ]
             context['expiring'] = expiring
 
-        if self.send_email:
-            template = 'messages/email/reminders/%s.html' % self.type.key.lower()
+        # Held until the owner's quiet hours are over
+        deliver_after = self.owner.deliver_after()
+
+        if reminder.send_email:
+            template = 'messages/email/reminders/%s.html' % type_key
             with app.test_request_context():
                 content = render_template(template, **context)
 
             # Queue message for celery
-            Messaging.objects.create(recipients=[self.owner.email],
-                                     sender=app.config['DEFAULT_MAIL_SENDER'],
-                                     subject=subject,
-                                     message=content)
-
-        if self.send_sms:
-            recipients=[]
-            if self.owner.can_receive_sms:
-                recipients.append(self.owner.cell_phone.sms_address)
-
-            if len(recipients) > 0:
-                template = 'messages/sms/reminders/%s.html' % self.type.key.lower()
-                with app.test_request_context():
-                    content = render_template(template, **context)
+            messages.append(Messaging(recipients=[self.owner.email],
+                                      sender=app.config['DEFAULT_MAIL_SENDER'],
+                                      subject=subject,
+                                      message=content,
+                                      allow_digest=True,
+                                      deliver_after=deliver_after))
+
+        if reminder.send_sms and self.owner.can_receive_sms:
+            template = 'messages/sms/reminders/%s.html' % type_key
+            with app.test_request_context():
+                content = render_template(template, **context)
 
-                # Make mobile friendly by removing excess whitespace
-                content = re.sub('\s{2,}', ' ', content)
+            # Make mobile friendly by removing excess whitespace
+            content = re.sub('\s{2,}', ' ', content)
 
-                subject = '%s reminder' % self.type.name
+            sms_subject = '%s reminder' % type_name
 
-                # Queue message for celery
-                Messaging.objects.create(recipients=recipients,
-                                         sender=app.config['DEFAULT_MAIL_SENDER'],
-                                         subject=subject.upper(), 
-                                         message=content,
-                                         is_plain=True)
+            # Queue message for celery
+            messages.append(Messaging(recipients=[self.owner.cell_phone.sms_address],
+                                      sender=app.config['DEFAULT_MAIL_SENDER'],
+                                      subject=sms_subject.upper(),
+                                      message=content,
+                                      is_plain=True,
+                                      allow_digest=True,
+                                      deliver_after=deliver_after))
 
-        # Record History, but don't bring down the house
         try:
             with app.test_request_context():
-                web_message = render_template('messages/web/reminders/%s.html' % self.type.key.lower(), **context)
-
-            ReminderHistory.objects.create(reminder=self,
-                                           card=card,
-                                           message=web_message,
-                                           sent_date=datetime.now(),
-                                           owner=self.owner)
+                web_message = render_template('messages/web/reminders/%s.html' % type_key, **context)
         except:
-            app.logger.exception('Could not save a reminder history object')
+            app.logger.exception('Could not render a reminder history message')
+            return messages, None
 
-        # Bump the last reminder
-        self.save()
+        record = ReminderHistory(reminder=reminder,
+                                 card=card,
+                                 message=web_message,
+                                 sent_date=datetime.now(),
+                                 owner=self.owner)
+        return messages, record
 
 
 class ReminderHistory(BaseDocument):
@@ -416,6 +693,9 @@ class ReminderHistory(BaseDocument):
     meta = {
         'collection': 'reminder_history',
         'queryset_class': ReminderHistoryQuerySet,
-        'indexes': ['sent_date'],
+        'indexes': [
+            'sent_date',
+            ('owner', 'sent_date')
+        ],
         'ordering': ['-sent_date']
     }
@@ -1,11 +1,13 @@
 import re
 
+from datetime import datetime
 from flask.ext.login import UserMixin
 from hashlib import md5, sha1
 
 from breezeminder.app import app
 from breezeminder.models.base import (BaseDocument,
                                       BaseQuerySet)
+from breezeminder.util.date import quiet_until
 
 
 PHONE_TYPES = [
@@ -46,6 +48,8 @@ class User(BaseDocument, UserMixin):
     cell_phone = app.db.EmbeddedDocumentField('PhoneNumber')
     cell_verify_code = app.db.StringField()  # Hash ObjectId()
     cell_verified = app.db.BooleanField(required=True, default=False)
+    quiet_start = app.db.IntField(min_value=0, max_value=23)
+    quiet_end = app.db.IntField(min_value=0, max_value=23)
 
     meta = {
         'collection': 'users',
@@ -83,6 +87,18 @@ class User(BaseDocument, UserMixin):
     def can_receive_sms(self):
         return getattr(self.cell_phone, 'number', '') and self.cell_verified
 
+    @property
+    def quiet_hours(self):
+        """ (start, end) hours during which queued messages are held. Defaults to QUIET_HOURS """
+        if self.quiet_start is None or self.quiet_end is None:
+            return app.config.get('QUIET_HOURS', (None, None))
+        return (self.quiet_start, self.quiet_end)
+
+    def deliver_after(self, when=None):
+        """ The earliest time a message queued at ``when`` may be sent to this user """
+        start, end = self.quiet_hours
+        return quiet_until(when or datetime.now(), start, end)
+
     def send_cell_verification(self):
         if getattr(self.cell_phone, 'number', ''):
             from breezeminder.models.messaging import Messaging
@@ -101,22 +117,18 @@ class User(BaseDocument, UserMixin):
         """ Properly handles the hashing """
         self.password = self.hash_password(password)
 
-    def check_reminders(self, card=None, **kwargs):
+    def check_reminders(self, card=None, types=None, **kwargs):
         """
         Check a user's reminders against a specified card or all
-        user cards if not supplied
+        user cards if not supplied. Optionally limited to a list of
+        reminder type keys
         """
         from breezeminder.models.card import BreezeCard
-        from breezeminder.models.reminder import Reminder
-
-        reminders = Reminder.objects.filter(owner=self)
-        check_cards = []
+        from breezeminder.models.reminder import ReminderEngine
 
         if card is not None:
-            check_cards.append(card)
+            check_cards = [card]
         else:
             check_cards = BreezeCard.objects.filter(owner=self)
 
-        for card in check_cards:
-            for reminder in reminders:
-                reminder.remind(card, **kwargs)
+        ReminderEngine(self).run(check_cards, types=types, **kwargs)
@@ -24,6 +24,7 @@ MARTA_ENDPOINT = 'http://developer.itsmarta.com/BRDRestService/BRDRestService.sv
 MARTA_RATE_LIMIT = '6/m'
 MARTA_RETRY_DELAY = 30
 MARTA_REALTIME_QUEUE = 'marta'
+MARTA_HISTORY_DAYS = 30
 
 if DEBUG:
     SERVER_PORT = 5000
@@ -61,17 +62,96 @@ DEFAULT_MAX_EMAILS = None
 MAIL_FAIL_SILENTLY = MAIL_DEBUG
 MAIL_SUPPRESS_SEND = False
 
+# Each mail queue run sends over this many persistent SMTP connections. Runs
+# lease their messages for MAIL_LEASE seconds, so several can go at once
+MAIL_DELIVERY_WORKERS = 2
+MAIL_LEASE = 10 * 60
+
+# Queued reminders for the same recipient created within this window of each
+# other are sent as one digest. None sends them separately
+MAIL_DIGEST_WINDOW = timedelta(minutes=15)
+
+# Queued messages are held between these hours, (start, end), unless
+# a user picks their own. (None, None) sends at any time
+QUIET_HOURS = (23, 7)
+
 # This should probably be watched. We don't want to flood the servers
 ALLOW_USER_REFRESH = False
 REFRESH_LIMITING = False
 REFRESH_INTERVAL = timedelta(minutes=30)
 
+# Each card backs off from REFRESH_INTERVAL while it stays the same and pulls
+# sooner once it changes, within these bounds
+REFRESH_INTERVAL_MIN = timedelta(minutes=15)
+REFRESH_INTERVAL_MAX = timedelta(hours=12)
+REFRESH_BACKOFF = 1.5
+
+# Reminder types are cached in each process for this many seconds
+REMINDER_TYPE_TTL = 60 * 60
+
+# New and edited reminders are checked against every card in the background,
+# this many seconds later. Edits made in the meantime are checked along with them
+REMINDER_CHECK_DELAY = 30
+REMINDER_CHECK_TIMEOUT = 10 * 60
+
 CARD_RETRY_DELAY = 15 * 60
-CARD_RATE_LIMIT = '10/m'
-CARD_STALE_THRESH = timedelta(minutes=10)
+
+# Cards come due from a redis sorted set. Each beat claims at most CARD_DUE_LIMIT
+# of them, leased for CARD_RETRY_DELAY seconds in case the pull fails. Of the
+# CARD_DUE_LIMIT * CARD_DUE_LOOKAHEAD longest overdue, those closest to a reminder
+# go first. Next pulls are spread out by up to CARD_REFRESH_JITTER. A claimed
+# card isn't claimed again until its batch is done, or CARD_CLAIM_HOLD seconds
+# pass should the batch be lost
+CARD_DUE_LIMIT = 20
+CARD_DUE_LOOKAHEAD = 4
+CARD_CLAIM_HOLD = 60 * 60
+
+# Should the due queue be found empty, every card is scheduled again and those
+# already due are spread over this many seconds
+CARD_RESEED_SPREAD = 60 * 60
+CARD_REFRESH_JITTER = timedelta(minutes=5)
+
+# Due cards are pulled in batches, fetched concurrently over keep-alive connections
+CARD_BATCH_SIZE = 20
+CARD_BATCH_RATE_LIMIT = '2/m'
+CARD_FETCH_CONCURRENCY = 4
+
+# Every worker draws card fetches from one shared budget ('redis') or its own
+# ('local'). The breaker pauses all pulls when too many fetches fail or take
+# longer than CARD_BREAKER_SLOW seconds within a window
+CARD_THROTTLE_BACKEND = 'redis'
+CARD_FETCH_RATE = '40/m'
+CARD_FETCH_BURST = 10
+CARD_FETCH_WAIT = 30
+
+# Seconds to wait on the breeze card site for each request. The session tries twice
+CARD_FETCH_TIMEOUT = 20
+
+# Background pulls leave this many tokens in the bucket for the priority lane,
+# first pulls and user refreshes, so those never wait behind a batch
+CARD_FETCH_RESERVE = 2
+
+# Only one worker pulls a card at a time. The lock expires after this many
+# seconds in case its worker dies mid pull. It has to outlast the longest pull:
+# waiting for a token, two timed out requests and a minute to save
+CARD_PULL_LOCK_TIMEOUT = CARD_FETCH_WAIT + 2 * CARD_FETCH_TIMEOUT + 60
+
+# A refresh a user asked for shows as pending until its pull finishes,
+# or this many seconds pass
+CARD_REFRESH_TIMEOUT = 5 * 60
+CARD_BREAKER_WINDOW = 60
+CARD_BREAKER_MIN_CALLS = 10
+CARD_BREAKER_THRESHOLD = 0.5
+CARD_BREAKER_SLOW = 10
+CARD_BREAKER_PAUSE = 5 * 60
 
 LOG_FILE = '/tmp/%s.log' % SITE_NAME.lower()
 
+# Application state. Kept apart from the celery broker database
+REDIS_HOST = "localhost"
+REDIS_PORT = 6379
+REDIS_DB = 1
+
 BROKER_TRANSPORT = "redis"
 BROKER_HOST = "localhost"
 BROKER_PORT = 6379
@@ -90,13 +170,44 @@ CELERY_IMPORTS = ('breezeminder.tasks', )
 CELERYD_CONCURRENCY = 1
 CELERY_ALWAYS_EAGER = False
 CELERY_DEFAULT_QUEUE = 'breezeminder'
+CELERY_DEFAULT_EXCHANGE = 'breezeminder'
+CELERY_DEFAULT_ROUTING_KEY = 'breezeminder'
+
+# Each workload has its own queue so that realtime data and verification
+# codes never wait behind bulk card pulls
+CELERY_QUEUES = dict((name, {'exchange': 'breezeminder', 'routing_key': name})
+                     for name in ('breezeminder', 'marta', 'mail.immediate', 'mail',
+                                  'cards', 'cards.priority', 'reminders'))
+CELERY_ROUTES = {
+    'tasks.pull_marta_realtime_data': {'queue': 'marta'},
+    'tasks.send_immediate_mail': {'queue': 'mail.immediate'},
+    'tasks.send_outgoing_mail': {'queue': 'mail'},
+    'tasks.pull_card_data': {'queue': 'cards.priority'},
+    'tasks.evaluate_reminders': {'queue': 'reminders'},
+    'tasks.check_reminder_cards': {'queue': 'reminders'},
+    'tasks.pull_card_batch': {'queue': 'cards'},
+}
+
+# One worker per queue, started with `manage.py worker --pool <queue>` or
+# BREEZEMINDER_WORKER_POOL=<queue>. Slow tasks prefetch one message at a
+# time so an idle worker in the same pool can take the next
+CELERY_WORKER_POOLS = {
+    'breezeminder': {'concurrency': 1, 'prefetch': 4},
+    'marta': {'concurrency': 1, 'prefetch': 1},
+    'mail.immediate': {'concurrency': 1, 'prefetch': 1},
+    'mail': {'concurrency': 1, 'prefetch': 1},
+    'cards': {'concurrency': 1, 'prefetch': 1},
+    'cards.priority': {'concurrency': 1, 'prefetch': 1},
+    'reminders': {'concurrency': 1, 'prefetch': 4},
+}
 
 from celery.schedules import crontab
 CELERYBEAT_SCHEDULE = {
-    # Run the mail queue every five minutes during reasonable hours
+    # Run the mail queue every five minutes. Messages are held
+    # for each user's quiet hours when they are queued
     'send-outgoing-mail-task': {
         'task': 'tasks.send_outgoing_mail',
-        'schedule': crontab(minute='*/5', hour='7-22')
+        'schedule': crontab(minute='*/5')
     },
 
     # Run the immediate mail queue every 30 seconds
@@ -105,7 +216,7 @@ CELERYBEAT_SCHEDULE = {
         'schedule': timedelta(seconds=30)
     },
 
-    # Run the periodic check for stale cards
+    # Dispatch pulls for cards that have come due
     'check-card-pull-task': {
         'task': 'tasks.check_card_pulls',
         'schedule': timedelta(seconds=30),
@@ -115,5 +226,11 @@ CELERYBEAT_SCHEDULE = {
     'pull-marta-realtime-data-task': {
         'task': 'tasks.pull_marta_realtime_data',
         'schedule': timedelta(seconds=10),
+    },
+
+    # Live bus positions are kept in redis. Save changes to mongo now and then
+    'persist-marta-buses-task': {
+        'task': 'tasks.persist_marta_buses',
+        'schedule': timedelta(minutes=1),
     }
 }
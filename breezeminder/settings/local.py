@@ -24,10 +24,12 @@ CACHE_DISABLED = False
 ALLOW_USER_REFRESH = DEBUG
 REFRESH_LIMITING = not DEBUG
 REFRESH_INTERVAL = timedelta(seconds=10)
+REFRESH_INTERVAL_MIN = REFRESH_INTERVAL
+REFRESH_INTERVAL_MAX = timedelta(minutes=1)
 
 CARD_RETRY_DELAY = 10
-CARD_RATE_LIMIT = '10/m'
-CARD_STALE_THRESH = timedelta(minutes=1)
+CARD_THROTTLE_BACKEND = 'local'
+CARD_REFRESH_JITTER = timedelta(seconds=5)
 
 CELERYBEAT_SCHEDULE = {
     'send-outgoing-mail-task': {
@@ -41,7 +43,7 @@ CELERYBEAT_SCHEDULE = {
         'schedule': timedelta(seconds=30)
     },
 
-    # Run the periodic check for stale cards
+    # Dispatch pulls for cards that have come due
     'check-card-pull-task': {
         'task': 'tasks.check_card_pulls',
         'schedule': timedelta(seconds=5),
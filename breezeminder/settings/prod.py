@@ -59,9 +59,21 @@ MAIL_SUPPRESS_SEND = False
 LOG_FILE = '/var/log/breezeminder/app.log'
 
 REFRESH_INTERVAL = timedelta(hours=8)
+REFRESH_INTERVAL_MIN = timedelta(hours=2)
+REFRESH_INTERVAL_MAX = timedelta(days=2)
 CARD_RETRY_DELAY = 15 * 60
-CARD_RATE_LIMIT = '10/m'
-CARD_STALE_THRESH = timedelta(minutes=10)
+CARD_REFRESH_JITTER = timedelta(minutes=30)
+
+# One beat a minute claims as many cards as six batches can pull
+CARD_DUE_LIMIT = 150
+CARD_BATCH_SIZE = 25
+CARD_BATCH_RATE_LIMIT = '6/m'
+CARD_FETCH_CONCURRENCY = 8
+
+# Cluster wide cap on requests to the breeze card endpoint
+CARD_FETCH_RATE = '150/m'
+CARD_FETCH_BURST = 25
+CARD_FETCH_RESERVE = 5
 
 # Let's use redis instead of mongo for our celery queuing
 BROKER_TRANSPORT = "redis"
@@ -74,12 +86,24 @@ CELERY_LOG_LEVEL = LOGGING_LEVEL
 CELERYD_LOG_LEVEL = CELERY_LOG_LEVEL
 CELERYBEAT_LOG_LEVEL = CELERY_LOG_LEVEL
 
+# Card batches fan out over CARD_FETCH_CONCURRENCY threads of their own
+CELERY_WORKER_POOLS = {
+    'breezeminder': {'concurrency': 1, 'prefetch': 4},
+    'marta': {'concurrency': 1, 'prefetch': 1},
+    'mail.immediate': {'concurrency': 1, 'prefetch': 1},
+    'mail': {'concurrency': 2, 'prefetch': 1},
+    'cards': {'concurrency': 4, 'prefetch': 1},
+    'cards.priority': {'concurrency': 2, 'prefetch': 1},
+    'reminders': {'concurrency': 2, 'prefetch': 4},
+}
+
 from celery.schedules import crontab
 CELERYBEAT_SCHEDULE = {
-    # Run the mail queue every five minutes during reasonable hours
+    # Run the mail queue every five minutes. Messages are held
+    # for each user's quiet hours when they are queued
     'send-outgoing-mail-task': {
         'task': 'tasks.send_outgoing_mail',
-        'schedule': crontab(minute='*/5', hour='7-22')
+        'schedule': crontab(minute='*/5')
     },
 
     # Run the immediate mail queue every 30 seconds
@@ -88,15 +112,21 @@ CELERYBEAT_SCHEDULE = {
         'schedule': timedelta(seconds=30)
     },
 
-    # Run the periodic check for stale cards
+    # Dispatch pulls for cards that have come due
     'check-card-pull-task': {
         'task': 'tasks.check_card_pulls',
-        'schedule': timedelta(minutes=5),
+        'schedule': timedelta(minutes=1),
     },
 
     # Run the pull of realtime marta data
     'pull-marta-realtime-data-task': {
         'task': 'tasks.pull_marta_realtime_data',
         'schedule': timedelta(seconds=10),
+    },
+
+    # Live bus positions are kept in redis. Save changes to mongo now and then
+    'persist-marta-buses-task': {
+        'task': 'tasks.persist_marta_buses',
+        'schedule': timedelta(minutes=1),
     }
 }
@@ -31,10 +31,15 @@ DEFAULT_MAIL_SENDER = 'no-reply@breezeminder.com'
 DEFAULT_MAX_EMAILS = None
 MAIL_FAIL_SILENTLY = MAIL_DEBUG
 MAIL_SUPPRESS_SEND = False
+QUIET_HOURS = (None, None)
 
 LOG_FILE = '/tmp/breezeminder.log'
 
+REDIS_DB = 15
+
 REFRESH_INTERVAL = timedelta(hours=3)
+REFRESH_INTERVAL_MIN = REFRESH_INTERVAL
+REFRESH_INTERVAL_MAX = REFRESH_INTERVAL
 
 # Let's use redis instead of mongo for our celery queuing
 BROKER_TRANSPORT = "redis"
@@ -48,4 +53,4 @@ CELERYD_LOG_LEVEL = CELERY_LOG_LEVEL
 CELERYBEAT_LOG_LEVEL = CELERY_LOG_LEVEL
 
 CARD_RETRY_DELAY = 15 * 60
-CARD_RATE_LIMIT = 1
+CARD_THROTTLE_BACKEND = 'local'
@@ -332,8 +332,9 @@
 
         // This is magic so should node fail, we can still serve the page
         if(this.socket) {
-            this.socket.subscribe('marta', handler);
-            this.socket.subscribe('marta/stale', scrubber);
+            var channel = 'marta/route/' + this.routeId;
+            this.socket.subscribe(channel, handler);
+            this.socket.subscribe(channel + '/stale', scrubber);
         } else {
             // Poll once every 30 seconds
             setInterval(handler, 30000);
@@ -1,17 +1,20 @@
 import json
 import requests
 
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
 from dateutil.parser import parse as parse_date
 from flask.ext.celery import Celery
 from juggernaut import Juggernaut
-from mongoengine.queryset import Q
 
 from breezeminder.app import app
 
-from breezeminder.models.card import BreezeCard
+from breezeminder.models.card import (BreezeCard,
+                                      PullInProgress,
+                                      fetch_breaker,
+                                      refresh_queue)
 from breezeminder.models.messaging import Messaging
-from breezeminder.models.marta import Bus
+from breezeminder.models.marta import Bus, BusHistory, live_buses
 
 
 celery = Celery(app)
@@ -24,48 +27,137 @@ DEFAULT_RETRY = 15 * 60
 
 @celery.task(name='tasks.check_card_pulls', ignore_result=True)
 def check_card_pulls():
-    """ Find cards that aren't scheduled for a pull """
+    """ Dispatch pulls for cards that have come due """
     logger = check_card_pulls.get_logger()
 
-    threshold = datetime.now() - app.config['REFRESH_INTERVAL'] - app.config['CARD_STALE_THRESH']
-    logger.info('Checking stale cards never loaded or loaded before %s' % threshold)
-
-    # Cards that were never loaded or are 'stale'
-    qs = Q(last_loaded=None) | Q(last_loaded__lte=threshold)
+    if not fetch_breaker.allow():
+        logger.warning('Card fetches are paused. Not claiming due cards')
+        return
+
+    # Every card is always in the queue. An empty one was never seeded or was lost
+    if not refresh_queue.count():
+        count = BreezeCard.objects.schedule_all(spread=app.config.get('CARD_RESEED_SPREAD', 60 * 60))
+        if count:
+            logger.warning('The card due queue was empty. Scheduled %s cards' % count)
+
+    limit = app.config.get('CARD_DUE_LIMIT', 20)
+    window = limit * app.config.get('CARD_DUE_LOOKAHEAD', 1)
+
+    # When more cards are due than we can pull, those closest to a reminder go first
+    candidates = refresh_queue.peek(window)
+    priorities = {}
+    if len(candidates) > limit:
+        priorities = dict((str(card_id), priority) for card_id, priority in
+                          BreezeCard.objects.filter(id__in=candidates).values_list('id', 'pull_priority'))
+
+    # Claimed cards are leased, not removed. A pull that never finishes
+    # leaves the card to come due again once the retry delay passes. Cards
+    # whose batch is still waiting in the queue are held, not claimed again
+    card_ids = refresh_queue.claim(limit,
+                                   lease=app.config.get('CARD_RETRY_DELAY', DEFAULT_RETRY),
+                                   window=window,
+                                   rank=lambda card_id: priorities.get(card_id) or 0.0,
+                                   hold=app.config.get('CARD_CLAIM_HOLD', 60 * 60))
+    logger.info('Claimed %s due cards' % len(card_ids))
+
+    batch_size = app.config.get('CARD_BATCH_SIZE', 20)
+    for i in range(0, len(card_ids), batch_size):
+        batch = card_ids[i:i + batch_size]
+        logger.debug('Scheduling batch of %s due cards' % len(batch))
+        pull_card_batch.delay(batch)
+
+
+@celery.task(name='tasks.pull_card_data', ignore_result=True)
+def pull_card_data(card_id, force=False):
+    """
+    Pulls a single card in the priority lane, e.g. a card's first pull or one
+    a user asked for. These run on the cards.priority queue and may use fetch
+    tokens that background batches leave in reserve. The shared fetch limiter
+    is their only rate limit. Only ``force`` pulls cards that aren't due
+    """
+    logger = pull_card_data.get_logger()
+    logger.info('Starting priority card pull task for card %s' % card_id)
 
-    for card in BreezeCard.objects.filter(qs):
-        logger.debug('Scheduling stale card %s' % card.number_masked)
-        pull_card_data.delay(card.id)
+    # Process the card. A successful pull schedules the next one, a failed
+    # pull is picked up again by check_card_pulls
+    try:
+        card = BreezeCard.objects.get(id=card_id)
+        if not force and not card.is_due():
+            logger.error('Card pull was scheduled but it is not due yet')
+        else:
+            try:
+                card.pull_data(check_reminders=True, priority=True)
+                logger.info('Card pull complete. Next pull after %s' % card.next_refresh)
+            finally:
+                # Anyone polling for this refresh can stop
+                app.redis.delete(card.refresh_key)
+    except PullInProgress:
+        logger.info('Card %s is already being pulled. Skipping' % card_id)
+    except BreezeCard.DoesNotExist:
+        logger.exception('Could not locate BreezeCard by id %s - WILL NOT RETRY' % card_id)
+    except Exception:
+        logger.exception('Pull card data task for id %s went full retard' % card_id)
 
 
-@celery.task(name='tasks.pull_card_data',
+@celery.task(name='tasks.pull_card_batch',
              ignore_result=True,
-             rate_limit=app.config.get('CARD_RATE_LIMIT', '10/m'),
-             default_retry_delay=app.config.get('CARD_RETRY_DELAY', DEFAULT_RETRY))
-def pull_card_data(card_id):
+             rate_limit=app.config.get('CARD_BATCH_RATE_LIMIT', '2/m'))
+def pull_card_batch(card_ids):
+    logger = pull_card_batch.get_logger()
+    logger.info('Starting batch card pull for %s cards' % len(card_ids))
+
+    # Failed cards stay leased in the due queue and are retried when it expires
+    failed = BreezeCard.objects.pull_batch(card_ids, check_reminders=True)
+    logger.info('Batch card pull complete. %s failed' % len(failed))
+
+
+@celery.task(name='tasks.evaluate_reminders', ignore_result=True)
+def evaluate_reminders(card_id, last_state=None, current_state=None, types=None):
+    """
+    Checks a card's reminders after a pull, comparing ``current_state`` to
+    ``last_state``. Both are CardSnapshots taken by the pull, so a later
+    pull of the same card can't change what this one is compared against
+    """
     # THIS TASK USES TEMPLATES. Make sure they are imported
     from breezeminder.app import context, filters
+    from breezeminder.models.reminder import ReminderEngine
 
-    logger = pull_card_data.get_logger()
-    logger.info('Starting card pull task for card %s' % card_id)
+    logger = evaluate_reminders.get_logger()
 
-    # Process the card
     try:
         card = BreezeCard.objects.get(id=card_id)
-        if card.last_loaded is not None and card.next_refresh >= datetime.now():
-            logger.error('Card pull was scheduled but it is not due yet')
-        else:
-            card.pull_data(check_reminders=True)
-            logger.info('Card pull complete')
+        if current_state is not None:
+            current_state.apply(card)
 
-            # Reschedule the next pull
-            logger.info('Rescheduling card %s for %s' % (card_id, card.next_refresh))
-            pull_card_data.apply_async((card_id, ), eta=card.next_refresh)
+        sent = ReminderEngine(card.owner).run([card], last_state=last_state, types=types)
+        logger.info('Sent %s reminders for card %s' % (sent, card.last_four))
     except BreezeCard.DoesNotExist:
-        logger.exception('Could not locate BreezeCard by id %s - WILL NOT RETRY' % card_id)
-    except Exception, exc:
-        logger.exception('Pull card data task for id %s went full retard. Retry.' % card_id)
-        pull_card_data.retry((card_id, ), exc=exc)
+        logger.error('Could not locate BreezeCard by id %s to check reminders' % card_id)
+    except Exception:
+        logger.exception('Reminder check for card %s failed' % card_id)
+
+
+@celery.task(name='tasks.check_reminder_cards', ignore_result=True)
+def check_reminder_cards(reminder_id):
+    """ Checks a new or edited reminder against all of its owner's cards """
+    # THIS TASK USES TEMPLATES. Make sure they are imported
+    from breezeminder.app import context, filters
+    from breezeminder.models.reminder import Reminder
+
+    logger = check_reminder_cards.get_logger()
+
+    # Edits from here on need a check of their own. Cleared before loading
+    # the reminder so that none are missed in between
+    app.redis.delete(Reminder.check_key_for(reminder_id))
+
+    try:
+        reminder = Reminder.objects.get(id=reminder_id)
+        reminder.check_all_cards(force=True)
+        logger.info('Checked reminder %s against all cards' % reminder_id)
+    except Reminder.DoesNotExist:
+        logger.error('Could not locate Reminder by id %s to check cards' % reminder_id)
+    except Exception:
+        logger.exception('Checking cards for reminder %s failed' % reminder_id)
 
 
 @celery.task(name='tasks.pull_marta_realtime_data',
@@ -75,13 +167,12 @@ def pull_card_data(card_id):
 def pull_marta_realtime_data():
     logger = pull_marta_realtime_data.get_logger()
     logger.info('Starting MARTA realtime pull')
-    stale = set(Bus.objects.filter(is_stale=False).values_list('id'))
 
     try:
         data = json.loads(requests.get(app.config['MARTA_ENDPOINT']).content)
         socket = Juggernaut()
         queue = app.config.get('MARTA_SOCKET_QUEUE', 'marta')
-        push = []
+        feed = []
 
         for info in data:
             defaults = {
@@ -100,33 +191,39 @@ def pull_marta_realtime_data():
             except (ValueError, KeyError):
                 defaults['adherence'] = 0
 
-            bus, created = Bus.objects.get_or_create(id=defaults['id'],
-                                                     defaults=defaults)
+            feed.append(defaults)
+
+        # Live positions are kept in redis. Mongo catches up in persist_marta_buses
+        changed, departed = live_buses.sync(feed)
 
-            if not created:
-                stale.discard(bus.id)
-                current = defaults['status_time'] > bus.status_time
-                updated = bus.update_maybe(**defaults)
+        try:
+            BusHistory.objects.append(changed)
+        except Exception:
+            logger.exception('Failed to record MARTA bus history')
+
+        # What route_realtime serves. Only "recent" buses are shown
+        live_buses.build_snapshots(datetime.now() - timedelta(hours=1))
 
-                if updated and current:
-                    bus.save()
-                    push.append(bus.to_json())
-            else:
-                push.append(bus.to_json())
+        # Each route gets its own channel so browsers only hear about the route they show
+        push, stale = defaultdict(list), defaultdict(list)
+        for record in changed:
+            push[record['route']].append(Bus(**record).to_json())
+        for record in departed:
+            stale[record['route']].append(record['id'])
 
         # Notify
         try:
             # Push new updates
-            if push:
-                logger.info('Publishing %s bus updates to queue %s' % (len(push), queue))
-                socket.publish(queue, push)
+            for route, buses in push.iteritems():
+                channel = '%s/route/%s' % (queue, route)
+                logger.info('Publishing %s bus updates to %s' % (len(buses), channel))
+                socket.publish(channel, buses)
 
             # Notify of staleness
-            if stale:
-                stale = list(stale)
-                logger.info('Publishing %s stale bus notices to %s/stale' % (len(stale), queue))
-                socket.publish('%s/stale' % queue, stale)
-                Bus.objects.filter(id__in=stale).update(set__is_stale=True)
+            for route, bus_ids in stale.iteritems():
+                channel = '%s/route/%s/stale' % (queue, route)
+                logger.info('Publishing %s stale bus notices to %s' % (len(bus_ids), channel))
+                socket.publish(channel, bus_ids)
 
         except:
             logger.exception("Can't push realtime MARTA notifications")
@@ -136,20 +233,30 @@ def pull_marta_realtime_data():
         logger.info('MARTA realtime pull finished')
 
 
+@celery.task(name='tasks.persist_marta_buses', ignore_result=True)
+def persist_marta_buses():
+    """ Writes buses that changed since the last run from redis to mongo """
+    logger = persist_marta_buses.get_logger()
+
+    records = live_buses.take_dirty()
+    try:
+        persisted = Bus.objects.persist(records)
+        logger.info('Persisted %s buses' % persisted)
+    except Exception:
+        # Try them again next time
+        if records:
+            app.redis.sadd(live_buses.dirty_key, *[record['id'] for record in records])
+        logger.exception('Failed to persist MARTA buses')
+
+
 def _process_mail_queue(logger, immediate=False, batch=100):
     queue_type = 'immediate' if immediate else 'queued'
 
     logger.info('Starting processing %s messages. Batched %s' % (queue_type, batch))
 
-    messages = Messaging.objects.filter(is_sent=False, is_immediate=immediate)
-
     # Try sending out a batch
     try:
-        processed = 0
-        for message in messages.order_by('created')[:batch]:
-            with app.mail.connect() as conn:
-                message.send(conn)
-                processed += 1
+        processed = Messaging.objects.deliver_pending(immediate=immediate, batch=batch)
         logger.info('Processed %s messages' % processed)
     except Exception, e:
         logger.exception('The mail processing queue went full retard')
@@ -1,3 +1,5 @@
 from breezeminder.tests.app import *
 from breezeminder.tests.forms import *
 from breezeminder.tests.models import *
+from breezeminder.tests.util import *
+from breezeminder.tests.views import *
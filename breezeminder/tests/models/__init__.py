@@ -1,5 +1,13 @@
 from breezeminder.tests.models.test_base import BaseQuerySetTestCase
 from breezeminder.tests.models.test_card import (NumberOnlyFormatTestCase,
-                                                 BreezeCardTestCase)
-from breezeminder.tests.models.test_reminder import ReminderTestCase
-from breezeminder.tests.models.test_messaging import MessagingTestCase
+                                                 BreezeCardTestCase,
+                                                 BreezeCardPullDataTestCase,
+                                                 BreezeCardPullBatchTestCase,
+                                                 CardSnapshotTestCase)
+from breezeminder.tests.models.test_reminder import (ReminderTestCase,
+                                                     ReminderEngineTestCase)
+from breezeminder.tests.models.test_messaging import (MessagingTestCase,
+                                                      MessagingQueueTestCase)
+from breezeminder.tests.models.test_marta import (BusPersistTestCase,
+                                                  BusHistoryTestCase,
+                                                  LiveBusesTestCase)
@@ -1,11 +1,25 @@
+import pickle
+import sys
+import time
+
+from bson import ObjectId
 from BeautifulSoup import BeautifulSoup
 from datetime import datetime, timedelta
-from mock import patch
+from mock import Mock, patch
 from unittest2 import TestCase
 
 from breezeminder.app import app
 from breezeminder.models.card import (BreezeCard,
-                                      format_numeric_number)
+                                      CardData,
+                                      CardSnapshot,
+                                      PendingTransaction,
+                                      Product,
+                                      PullInProgress,
+                                      _release,
+                                      format_numeric_number,
+                                      refresh_queue)
+from breezeminder.models.reminder import Reminder
+from breezeminder.models.user import User
 from breezeminder.util.testing import silence_is_golden
 
 
@@ -127,6 +141,44 @@ class BreezeCardTestCase(TestCase):
                                        month=self.test_date['month'],
                                        day=self.test_date['day'] + 1))
 
+    def test_next_refresh_adapted(self):
+        mock_config = {'REFRESH_INTERVAL': timedelta(days=1)}
+
+        with patch.dict(app.config, values=mock_config, clear=True):
+            self.card.refresh_interval = 60 * 60
+            self.assertEquals(self.card.next_refresh,
+                              datetime(year=self.test_date['year'],
+                                       month=self.test_date['month'],
+                                       day=self.test_date['day'],
+                                       hour=1))
+
+    def test_adapt_refresh_interval(self):
+        mock_config = {
+            'REFRESH_INTERVAL': timedelta(hours=4),
+            'REFRESH_INTERVAL_MIN': timedelta(hours=1),
+            'REFRESH_INTERVAL_MAX': timedelta(hours=8),
+            'REFRESH_BACKOFF': 1.5
+        }
+        now = datetime(2012, 6, 1)
+
+        with patch.dict(app.config, values=mock_config, clear=True):
+            # Unchanged pulls back off up to the max
+            self.card.adapt_refresh_interval(changed=False, now=now)
+            self.assertEquals(self.card.refresh_interval, 6 * 60 * 60)
+            self.card.adapt_refresh_interval(changed=False, now=now)
+            self.assertEquals(self.card.refresh_interval, 8 * 60 * 60)
+
+            # A change halves it
+            self.card.adapt_refresh_interval(changed=True, now=now)
+            self.assertEquals(self.card.refresh_interval, 4 * 60 * 60)
+            self.assertEquals(self.card.last_changed, now)
+
+            # Frequent changes pull it down to the min
+            self.card.adapt_refresh_interval(changed=True, now=now + timedelta(hours=3))
+            self.assertEquals(self.card.refresh_interval, int(1.5 * 60 * 60))
+            self.card.adapt_refresh_interval(changed=True, now=now + timedelta(hours=4))
+            self.assertEquals(self.card.refresh_interval, 60 * 60)
+
     def test_can_refresh_with_limiting(self):
         mock_config = {
             'REFRESH_INTERVAL': timedelta(days=1),
@@ -184,6 +236,79 @@ class BreezeCardTestCase(TestCase):
         self.assertEquals('', self.card.number)
         self.assertEquals('', self.card.last_four)
 
+    @patch('breezeminder.models.card.refresh_queue')
+    def test_schedule_refresh_before_reminder(self, mock_queue):
+        mock_config = {
+            'REFRESH_INTERVAL': timedelta(hours=8),
+            'CARD_REFRESH_JITTER': timedelta(0)
+        }
+        reminder = Reminder(type='EXP', threshold=2, quantifier='days')
+        self.card.id = ObjectId()
+        self.card.products = []
+
+        with patch.dict(app.config, values=mock_config, clear=True):
+            # Backed off to two days, the card would miss the day its reminder fires
+            now = datetime.now()
+            fire_day = (now + timedelta(days=1)).date()
+            self.card.last_loaded = now
+            self.card.refresh_interval = 2 * 24 * 60 * 60
+            self.card.expiration_date = datetime.combine(fire_day, datetime.min.time()) + timedelta(days=2)
+
+            self.card.schedule_refresh(reminders=[reminder])
+            when = mock_queue.schedule.call_args[0][1]
+            self.assertEquals(datetime.combine(fire_day, datetime.min.time()), when)
+
+            # Pulled that day, the reminder fires
+            with patch('breezeminder.models.reminder.datetime') as mock_datetime:
+                mock_datetime.now.return_value = when
+                self.assertTrue(reminder.check_reminder(self.card))
+
+            # Without reminders the backed off interval stands
+            self.card.schedule_refresh(reminders=[])
+            self.assertEquals(self.card.next_refresh, mock_queue.schedule.call_args[0][1])
+
+    @silence_is_golden
+    def test_pull_data_single_flight(self, *args):
+        self.card.id = ObjectId()
+        lock = self.card.pull_lock()
+        self.assertTrue(lock.acquire(blocking=False))
+        try:
+            with patch.object(BreezeCard, '_pull_data') as mock_pull:
+                self.assertRaises(PullInProgress, self.card.pull_data)
+                self.assertFalse(mock_pull.called)
+        finally:
+            lock.release()
+
+        # Released once the pull is over
+        with patch.object(BreezeCard, '_pull_data') as mock_pull:
+            self.card.pull_data()
+            self.card.pull_data()
+            self.assertEquals(2, mock_pull.call_count)
+
+    @patch('breezeminder.tasks.pull_card_data')
+    def test_request_refresh(self, mock_task):
+        self.card.id = ObjectId()
+        try:
+            self.assertFalse(self.card.is_refreshing)
+            self.assertTrue(self.card.request_refresh())
+            self.assertTrue(self.card.is_refreshing)
+
+            # Asking again joins the refresh already queued
+            self.assertFalse(self.card.request_refresh())
+            mock_task.delay.assert_called_once_with(self.card.id, force=True)
+        finally:
+            app.redis.delete(self.card.refresh_key)
+
+    def test_is_refreshing_while_pulling(self):
+        self.card.id = ObjectId()
+        lock = self.card.pull_lock()
+        lock.acquire(blocking=False)
+        try:
+            self.assertTrue(self.card.is_refreshing)
+        finally:
+            lock.release()
+        self.assertFalse(self.card.is_refreshing)
+
     @silence_is_golden
     def test_parse_expiration_date(self, *args):
         self.assertEquals(self.card._parse_expiration_date(self.soup),
@@ -236,3 +361,258 @@ class BreezeCardTestCase(TestCase):
 
         empty_autoloads = self.card._parse_pending_transactions(self.empty_soup)
         self.assertEquals(0, len(empty_autoloads))
+
+
+class BreezeCardPullDataTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User(email='pull-data@example.com', password='secret')
+        self.user.save()
+        self.card = BreezeCard(owner=self.user, number='1111222233334444')
+        self.card.save()
+
+    def tearDown(self):
+        refresh_queue.remove(self.card.id)
+        BreezeCard.objects.filter(owner=self.user).delete()
+        self.user.delete()
+
+    def _pull(self, content):
+        """ Pulls ``content`` as if the last pull was a while ago. Returns the reminder check """
+        BreezeCard.objects(id=self.card.id).update_one(set__last_loaded=datetime(2012, 6, 1))
+        self.card.reload()
+
+        with patch.object(BreezeCard, 'queue_reminders') as mock_queue:
+            self.card.pull_data(check_reminders=True, content=content)
+        return mock_queue
+
+    def _raw(self):
+        return BreezeCard._get_collection().find_one({'_id': self.card.id})
+
+    @silence_is_golden
+    def test_unchanged(self, *args):
+        self._pull(FAKE_CONTENT)
+        data_id = CardData.objects.get(card=self.card).id
+        before = self._raw()
+
+        mock_queue = self._pull(FAKE_CONTENT)
+        after = self._raw()
+
+        # No new card data, and only bookkeeping fields change
+        self.assertEquals([data_id], [data.id for data in CardData.objects.filter(card=self.card)])
+        changed = set(key for key in set(before) | set(after) if before.get(key) != after.get(key))
+        self.assertIn('last_loaded', changed)
+        self.assertTrue(changed <= set(['last_loaded', 'refresh_interval', 'pull_priority']))
+
+        # Only expiration reminders can come due
+        mock_queue.assert_called_once_with(types=['EXP'])
+
+    @silence_is_golden
+    def test_changed(self, *args):
+        self._pull(FAKE_CONTENT)
+        data_id = CardData.objects.get(card=self.card).id
+        digest = self.card.content_digest
+
+        mock_queue = self._pull(FAKE_CONTENT.replace('$100.00', '$90.00'))
+
+        self.assertNotEquals(data_id, CardData.objects.get(card=self.card).id)
+        self.assertNotEquals(digest, self._raw()['content_digest'])
+        self.assertEquals(90, float(self.card.stored_value))
+        self.assertEquals(100, float(mock_queue.call_args[1]['last_state'].stored_value))
+
+    @silence_is_golden
+    def test_unchanged_without_data(self, *args):
+        self._pull(FAKE_CONTENT)
+        data_id = CardData.objects.get(card=self.card).id
+        BreezeCard.objects(id=self.card.id).update_one(set__has_data=False)
+
+        # Same document, but nothing to compare against takes the full path
+        mock_queue = self._pull(FAKE_CONTENT)
+        self.assertNotEquals(data_id, CardData.objects.get(card=self.card).id)
+        self.assertTrue(self._raw()['has_data'])
+        self.assertIn('last_state', mock_queue.call_args[1])
+
+    @silence_is_golden
+    def test_shorturl_saves_only_itself(self, *args):
+        self._pull(FAKE_CONTENT)
+        snapshot = CardSnapshot.from_card(self.card)
+
+        # A newer pull lands while reminders are checked against the old snapshot
+        BreezeCard.objects(id=self.card.id).update_one(set__stored_value='50.00')
+        self.card.reload()
+        snapshot.apply(self.card)
+
+        bitly = Mock()
+        bitly.Connection.return_value.shorten.return_value = {'url': 'http://j.mp/test'}
+        with patch.dict(sys.modules, {'bitly_api': bitly}):
+            self.assertEquals('http://j.mp/test', self.card.shorturl)
+
+        self.assertEquals('http://j.mp/test', self._raw()['_shorturl'])
+        self.assertEquals(50, float(BreezeCard.objects.get(id=self.card.id).stored_value))
+
+
+class BreezeCardPullBatchTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User(email='pull-batch@example.com', password='secret')
+        self.user.save()
+        self.cards = []
+        for number in ['1111222233334444', '5555666677778888']:
+            card = BreezeCard(owner=self.user, number=number)
+            card.save()
+            self.cards.append(card)
+        self.ids = [card.id for card in self.cards]
+
+    def tearDown(self):
+        refresh_queue.remove(*self.ids)
+        refresh_queue.release(*self.ids)
+        BreezeCard.objects.filter(owner=self.user).delete()
+        self.user.delete()
+
+    @silence_is_golden
+    def test_dispatched_twice(self, *args):
+        with patch.object(BreezeCard, 'fetch_content', return_value=FAKE_CONTENT) as mock_fetch:
+            self.assertEquals([], BreezeCard.objects.pull_batch(self.ids))
+
+            # The second batch finds the cards are no longer due
+            self.assertEquals([], BreezeCard.objects.pull_batch(self.ids))
+            self.assertEquals(2, mock_fetch.call_count)
+
+        for card in BreezeCard.objects.filter(id__in=self.ids):
+            self.assertTrue(card.has_data)
+            self.assertFalse(card.is_due())
+
+    @silence_is_golden
+    def test_reminders_loaded_once(self, *args):
+        with patch.object(BreezeCard, 'fetch_content', return_value=FAKE_CONTENT):
+            with patch.object(BreezeCard, 'update_pull_priority', return_value=0.0) as mock_priority:
+                with patch('breezeminder.models.reminder.ReminderEngine') as mock_engine:
+                    self.assertEquals([], BreezeCard.objects.pull_batch(self.ids))
+
+        # Each card is handed the reminders loaded for the batch
+        self.assertFalse(mock_engine.called)
+        self.assertEquals(2, mock_priority.call_count)
+        for call in mock_priority.call_args_list:
+            self.assertEquals(([], ), call[0])
+
+    @silence_is_golden
+    def test_failed_fetch(self, *args):
+        def fetch(card, *args, **kwargs):
+            if card.id == self.ids[0]:
+                raise Exception('Fetch failed')
+            return FAKE_CONTENT
+
+        with patch.object(BreezeCard, 'fetch_content', autospec=True, side_effect=fetch):
+            self.assertEquals([self.ids[0]], BreezeCard.objects.pull_batch(self.ids))
+
+        self.assertFalse(BreezeCard.objects.get(id=self.ids[0]).has_data)
+        self.assertTrue(BreezeCard.objects.get(id=self.ids[1]).has_data)
+
+    @silence_is_golden
+    def test_deleted_cards(self, *args):
+        BreezeCard.objects.filter(id=self.ids[0]).delete()
+        refresh_queue.schedule(self.ids[0], datetime.now())
+
+        with patch.object(BreezeCard, 'fetch_content', return_value=FAKE_CONTENT) as mock_fetch:
+            self.assertEquals([], BreezeCard.objects.pull_batch(self.ids))
+            self.assertEquals(1, mock_fetch.call_count)
+
+        self.assertIsNone(refresh_queue.due_at(self.ids[0]))
+
+    @silence_is_golden
+    def test_locked_cards(self, *args):
+        lock = self.cards[0].pull_lock()
+        self.assertTrue(lock.acquire(blocking=False))
+        try:
+            with patch.object(BreezeCard, 'fetch_content', return_value=FAKE_CONTENT) as mock_fetch:
+                self.assertEquals([], BreezeCard.objects.pull_batch(self.ids))
+                self.assertEquals(1, mock_fetch.call_count)
+        finally:
+            lock.release()
+
+        self.assertFalse(BreezeCard.objects.get(id=self.ids[0]).has_data)
+        self.assertTrue(BreezeCard.objects.get(id=self.ids[1]).has_data)
+
+    @silence_is_golden
+    def test_locks_released_on_error(self, *args):
+        with patch.object(BreezeCard, 'fetch_content', return_value=FAKE_CONTENT):
+            with patch.object(BreezeCard, '_pull_data', side_effect=KeyboardInterrupt):
+                self.assertRaises(KeyboardInterrupt, BreezeCard.objects.pull_batch, self.ids)
+
+        for card in self.cards:
+            lock = card.pull_lock()
+            self.assertTrue(lock.acquire(blocking=False))
+            lock.release()
+
+    @silence_is_golden
+    def test_expired_lock_kept(self, *args):
+        lock = self.cards[0].pull_lock()
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.acquired_until = time.time() - 1
+
+        # Another worker took the lock over once ours expired
+        other = self.cards[0].pull_lock()
+        app.redis.set(other.name, time.time() + 60)
+        try:
+            _release(lock)
+            self.assertTrue(app.redis.exists(other.name))
+        finally:
+            app.redis.delete(other.name)
+
+    @silence_is_golden
+    def test_breaker_open(self, *args):
+        with patch('breezeminder.models.card.fetch_breaker') as mock_breaker:
+            mock_breaker.allow.return_value = False
+            with patch.object(BreezeCard, 'fetch_content') as mock_fetch:
+                self.assertEquals(self.ids, BreezeCard.objects.pull_batch(self.ids))
+                self.assertFalse(mock_fetch.called)
+
+
+class CardSnapshotTestCase(TestCase):
+
+    def setUp(self):
+        self.card = BreezeCard(stored_value=12.5,
+                               expiration_date=datetime(year=1984, month=12, day=2))
+        self.card.products = [Product(name='Foo', remaining_rides=3)]
+        self.card.pending = [PendingTransaction(name='Bar', value=10)]
+
+    def test_from_card(self):
+        snapshot = CardSnapshot.from_card(self.card)
+        self.assertEquals(self.card.stored_value, snapshot.stored_value)
+        self.assertEquals(self.card.expiration_date, snapshot.expiration_date)
+        self.assertEquals('Foo', snapshot.products[0].name)
+        self.assertEquals(3, snapshot.products[0].remaining_rides)
+        self.assertEquals('Bar', snapshot.pending[0].name)
+
+        # Products compare by name, so they can be looked up in a snapshot
+        self.assertIn(Product(name='Foo'), snapshot.products)
+        self.assertNotIn(Product(name='Baz'), snapshot.products)
+        self.assertIn(PendingTransaction(name='Bar'), snapshot.pending)
+
+    def test_is_detached(self):
+        snapshot = CardSnapshot.from_card(self.card)
+        self.card.stored_value = 0
+        self.card.products.append(Product(name='Baz'))
+        self.assertEquals(12.5, snapshot.stored_value)
+        self.assertEquals(1, len(snapshot.products))
+
+    def test_apply(self):
+        snapshot = CardSnapshot.from_card(self.card)
+        card = BreezeCard(stored_value=0)
+        snapshot.apply(card)
+
+        self.assertEquals(12.5, card.stored_value)
+        self.assertEquals(self.card.expiration_date, card.expiration_date)
+        self.assertEquals(3, card.products[0].remaining_rides)
+        self.assertTrue(isinstance(card.products[0], Product))
+        self.assertEquals('Bar', card.pending[0].name)
+
+    def test_immutable(self):
+        snapshot = CardSnapshot.from_card(self.card)
+        with self.assertRaises(AttributeError):
+            snapshot.stored_value = 0
+
+    def test_pickle(self):
+        snapshot = CardSnapshot.from_card(self.card)
+        loaded = pickle.loads(pickle.dumps(snapshot))
+        self.assertEquals(snapshot.stored_value, loaded.stored_value)
+        self.assertEquals(snapshot.products, loaded.products)
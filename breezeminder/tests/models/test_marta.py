@@ -0,0 +1,177 @@
+import json
+
+from datetime import datetime, timedelta
+from unittest2 import TestCase
+
+from breezeminder.app import app
+from breezeminder.models.marta import Bus, BusHistory, LiveBuses
+
+
+def _record(bus_id, status_time, **kwargs):
+    record = {
+        'id': bus_id,
+        'direction': 'Northbound',
+        'route': '110',
+        'location': (33.7, -84.3),
+        'status_time': status_time,
+        'timepoint': 'FIVE POINTS',
+        'stop_id': '1',
+        'adherence': 0,
+        'is_stale': False
+    }
+    record.update(kwargs)
+    return record
+
+
+class LiveBusesTestCase(TestCase):
+
+    def setUp(self):
+        self.now = datetime(2012, 6, 1, 12, 0)
+        self.live = LiveBuses(app.redis, 'breezeminder:test:marta')
+        self.live.sync([_record('test-1', self.now), _record('test-2', self.now)])
+        self.live.take_dirty()
+
+    def tearDown(self):
+        keys = app.redis.keys('breezeminder:test:marta:*')
+        if keys:
+            app.redis.delete(*keys)
+
+    def test_sync(self):
+        later = self.now + timedelta(seconds=30)
+        feed = [
+            _record('test-1', later, location=(33.8, -84.3)),
+            _record('test-3', later, route='2'),
+        ]
+
+        changed, departed = self.live.sync(feed)
+        self.assertEqual(sorted(record['id'] for record in changed), ['test-1', 'test-3'])
+        self.assertEqual([record['id'] for record in departed], ['test-2'])
+        self.assertTrue(departed[0]['is_stale'])
+
+        buses = self.live.all()
+        self.assertEqual(buses['test-1']['location'], [33.8, -84.3])
+        self.assertTrue(buses['test-2']['is_stale'])
+        self.assertEqual(buses['test-3']['status_time'], later)
+
+        # Stale buses leave their route
+        self.assertEqual([record['id'] for record in self.live.for_route('110')], ['test-1'])
+        self.assertEqual([record['id'] for record in self.live.for_route('2')], ['test-3'])
+
+    def test_sync_unchanged(self):
+        changed, departed = self.live.sync([_record('test-1', self.now), _record('test-2', self.now)])
+        self.assertEqual(changed, [])
+        self.assertEqual(departed, [])
+        self.assertEqual(self.live.take_dirty(), [])
+
+    def test_sync_ignores_old_reports(self):
+        feed = [_record('test-1', self.now - timedelta(minutes=1), adherence=5),
+                _record('test-2', self.now)]
+
+        changed, departed = self.live.sync(feed)
+        self.assertEqual(changed, [])
+        self.assertEqual(self.live.all()['test-1']['adherence'], 0)
+
+    def test_sync_changes_route(self):
+        changed, departed = self.live.sync([_record('test-1', self.now + timedelta(seconds=30), route='2'),
+                                            _record('test-2', self.now)])
+        self.assertEqual([(record['id'], record['route']) for record in departed], [('test-1', '110')])
+        self.assertEqual([record['id'] for record in self.live.for_route('110')], ['test-2'])
+        self.assertEqual([record['id'] for record in self.live.for_route('2')], ['test-1'])
+
+    def test_take_dirty(self):
+        self.live.sync([_record('test-1', self.now + timedelta(seconds=30)),
+                        _record('test-2', self.now)])
+
+        self.assertEqual([record['id'] for record in self.live.take_dirty()], ['test-1'])
+        self.assertEqual(self.live.take_dirty(), [])
+
+    def test_build_snapshots(self):
+        self.assertEqual(self.live.snapshot('110'), (None, '[]'))
+        self.assertEqual(self.live.build_snapshots(self.now), ['110'])
+
+        version, data = self.live.snapshot('110')
+        self.assertTrue(version.endswith('.1'))
+        self.assertEqual([bus['id'] for bus in json.loads(data)], ['test-1', 'test-2'])
+
+        # Nothing new, nothing rebuilt
+        self.assertEqual(self.live.build_snapshots(self.now), [])
+        self.assertEqual(self.live.snapshot('110')[0], version)
+
+        # Too old to show
+        self.assertEqual(self.live.build_snapshots(self.now + timedelta(seconds=1)), ['110'])
+        generation = version.split('.')[0]
+        self.assertEqual(self.live.snapshot('110'), ('%s.2' % generation, '[]'))
+
+    def test_snapshot_generation(self):
+        self.live.build_snapshots(self.now)
+        version = self.live.snapshot('110')[0]
+
+        # Losing the snapshot must not bring back an old version
+        app.redis.delete(self.live.snapshot_key('110'))
+        self.live.build_snapshots(self.now)
+        self.assertNotEqual(version, self.live.snapshot('110')[0])
+
+
+class BusPersistTestCase(TestCase):
+
+    def setUp(self):
+        self.now = datetime(2012, 6, 1, 12, 0)
+        self.ids = ['test-1', 'test-2']
+        Bus(**_record('test-1', self.now)).save()
+
+    def tearDown(self):
+        Bus.objects.filter(id__in=self.ids).delete()
+
+    def test_persist(self):
+        later = self.now + timedelta(seconds=30)
+        records = [_record('test-1', later, location=[33.8, -84.3], is_stale=True),
+                   _record('test-2', later)]
+
+        self.assertEqual(Bus.objects.persist(records), 2)
+        self.assertEqual(Bus.objects.get(id='test-1').location, [33.8, -84.3])
+        self.assertTrue(Bus.objects.get(id='test-1').is_stale)
+        self.assertEqual(Bus.objects.get(id='test-2').status_time, later)
+        self.assertEqual(Bus.objects.persist([]), 0)
+
+
+class BusHistoryTestCase(TestCase):
+
+    def setUp(self):
+        self.now = datetime(2012, 6, 1, 12, 30)
+
+    def tearDown(self):
+        BusHistory.objects.filter(bus_id__in=['test-1', 'test-2']).delete()
+
+    def test_append(self):
+        later = self.now + timedelta(minutes=45)
+        records = [_record('test-1', self.now),
+                   _record('test-1', self.now + timedelta(seconds=30), location=(33.8, -84.3), adherence=-2),
+                   _record('test-1', later),
+                   _record('test-2', self.now, route='2')]
+
+        self.assertEqual(BusHistory.objects.append(records), 4)
+        self.assertEqual(BusHistory.objects.append([]), 0)
+
+        # One bucket per bus, route and hour
+        self.assertEqual(BusHistory.objects.filter(bus_id='test-1').count(), 2)
+
+        bucket = BusHistory.objects.get(bus_id='test-1', hour=datetime(2012, 6, 1, 12))
+        self.assertEqual(bucket.t, [1800, 1830])
+        self.assertEqual(bucket.lat, [33.7, 33.8])
+        self.assertEqual(bucket.adherence, [0, -2])
+        self.assertEqual(bucket.expires, datetime(2012, 7, 1, 12))
+
+    def test_positions(self):
+        later = self.now + timedelta(minutes=45)
+        BusHistory.objects.append([_record('test-1', self.now),
+                                   _record('test-1', later),
+                                   _record('test-2', self.now, route='2')])
+
+        positions = BusHistory.objects.for_route('110', self.now, later).positions(self.now, later)
+        self.assertEqual([position['status_time'] for position in positions], [self.now, later])
+        self.assertEqual(positions[0]['location'], [33.7, -84.3])
+
+        # Only within the window
+        positions = BusHistory.objects.for_bus('test-1', later, later).positions(later, later)
+        self.assertEqual(len(positions), 1)
+        self.assertEqual(BusHistory.objects.for_route('2', later, later).positions(later, later), [])
@@ -1,6 +1,7 @@
+from datetime import datetime, timedelta
 from unittest2 import TestCase
 
-from breezeminder.models.messaging import Messaging
+from breezeminder.models.messaging import Messaging, coalesce
 
 
 class MessagingTestCase(TestCase):
@@ -15,3 +16,97 @@ class MessagingTestCase(TestCase):
         masked = self.message._get_masked_recipients()
         self.assertEqual('***@bar.com', masked[0])
         self.assertEqual('***@baz.com', masked[1])
+
+    def _queued(self, minutes, recipient='foo@bar.com', is_plain=False, allow_digest=True):
+        return Messaging(subject='Reminder %s' % minutes,
+                         message='<p>Hi</p>\n<!-- content -->\n<p>Reminder</p>\n<!-- /content -->\n<p>Bye</p>',
+                         recipients=[recipient],
+                         is_plain=is_plain,
+                         allow_digest=allow_digest,
+                         created=datetime(2012, 6, 1) + timedelta(minutes=minutes))
+
+    def test_coalesce(self):
+        first = self._queued(0)
+        second = self._queued(5)
+        late = self._queued(30)
+        sms = self._queued(1, is_plain=True)
+        other = self._queued(2, recipient='bar@baz.com')
+        welcome = self._queued(3, allow_digest=False)
+
+        groups = coalesce([late, welcome, second, other, sms, first], timedelta(minutes=15))
+        self.assertEqual([[m.subject for m in group] for group in groups],
+                         [['Reminder 0', 'Reminder 5'], ['Reminder 1'], ['Reminder 2'],
+                          ['Reminder 3'], ['Reminder 30']])
+
+    def test_digest_content(self):
+        self.assertEqual(self._queued(0).digest_content, '<p>Reminder</p>')
+
+        plain = self._queued(0, is_plain=True)
+        self.assertEqual(plain.digest_content, plain.message)
+
+    def test_digest(self):
+        digest = Messaging.digest([self._queued(0), self._queued(1)])
+        self.assertEqual(digest.subject, '[BreezeMinder] 2 reminders')
+        self.assertEqual(digest.message.count('<p>Reminder</p>'), 2)
+        self.assertEqual(digest.recipients, ['foo@bar.com'])
+
+        sms = Messaging.digest([self._queued(0, is_plain=True), self._queued(1, is_plain=True)])
+        self.assertEqual(sms.subject, '2 REMINDERS')
+        self.assertTrue(sms.is_plain)
+
+
+class MessagingQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.messages = [Messaging.objects.create(subject='Queue %s' % i,
+                                                  message='Bar',
+                                                  sender='no-reply@foo.com',
+                                                  recipients=['foo@bar.com'])
+                         for i in range(4)]
+        self.ids = set(m.id for m in self.messages)
+
+    def tearDown(self):
+        Messaging.objects.filter(id__in=list(self.ids)).delete()
+
+    def _claimed(self, messages):
+        return set(m.id for m in messages) & self.ids
+
+    def test_claims_are_exclusive(self):
+        first_token, first = Messaging.objects.claim(batch=2)
+        second_token, second = Messaging.objects.claim(batch=1000)
+
+        self.assertNotEqual(first_token, second_token)
+        self.assertFalse(self._claimed(first) & self._claimed(second))
+        self.assertEqual(self._claimed(first) | self._claimed(second), self.ids)
+
+        Messaging.objects.release(first_token)
+        Messaging.objects.release(second_token)
+
+    def test_release(self):
+        token, claimed = Messaging.objects.claim(batch=1000)
+        sent = [self.messages[0].id]
+        Messaging.objects.release(token, sent)
+
+        self.assertTrue(Messaging.objects.get(id=sent[0]).is_sent)
+
+        # The rest can be claimed again
+        token, claimed = Messaging.objects.claim(batch=1000)
+        self.assertEqual(self._claimed(claimed), self.ids - set(sent))
+        Messaging.objects.release(token)
+
+    def test_expired_leases_are_reclaimed(self):
+        token, claimed = Messaging.objects.claim(batch=1000)
+        Messaging.objects.filter(lease_owner=token).update(set__lease_expires=datetime.now() - timedelta(seconds=1))
+
+        token, claimed = Messaging.objects.claim(batch=1000)
+        self.assertEqual(self._claimed(claimed), self.ids)
+        Messaging.objects.release(token)
+
+    def test_held_messages_are_not_claimed(self):
+        held = self.messages[0]
+        held.deliver_after = datetime.now() + timedelta(hours=1)
+        held.save()
+
+        token, claimed = Messaging.objects.claim(batch=1000)
+        self.assertEqual(self._claimed(claimed), self.ids - set([held.id]))
+        Messaging.objects.release(token)
@@ -1,10 +1,16 @@
+from bson import ObjectId
 from copy import deepcopy
-from datetime import datetime
+from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
-from mock import Mock
+from mock import Mock, patch
 from unittest2 import TestCase
 
-from breezeminder.models.reminder import Reminder
+from breezeminder.app import app
+from breezeminder.models.card import CardSnapshot
+from breezeminder.models.reminder import (Reminder,
+                                          ReminderEngine,
+                                          ReminderType,
+                                          reminder_types)
 from breezeminder.util.testing import silence_is_golden
 
 
@@ -30,6 +36,26 @@ class ReminderTestCase(TestCase):
             prod.remaining_rides = i
             self.card.products.append(prod)
 
+    def test_type_key(self):
+        self.assertEqual(self.bal_rem.type_key, 'BAL')
+        self.assertEqual(self.exp_rem.reminder_type, reminder_types.get_by_key('EXP'))
+
+    def test_reminder_type_equality(self):
+        bal = reminder_types.get_by_key('BAL')
+        self.assertTrue(bal == 'BAL')
+        self.assertTrue(bal != 'EXP')
+        self.assertTrue(bal == reminder_types.get(bal.id))
+        self.assertTrue(bal != reminder_types.get_by_key('EXP'))
+        self.assertFalse(bal == 1)
+
+    def test_registry_missing(self):
+        self.assertRaises(ReminderType.DoesNotExist, reminder_types.get_by_key, 'FOO')
+
+    @silence_is_golden
+    def test_check_reminder_unknown_type(self, *args):
+        self.bal_rem.type = None
+        self.assertRaises(NotImplementedError, self.bal_rem.check_reminder, self.card)
+
     def test_description(self):
         self.assertIn('Stored Value', self.bal_rem.description(html=False))
         self.assertIn('$19.99', self.bal_rem.description(html=False))
@@ -130,3 +156,131 @@ class ReminderTestCase(TestCase):
         for prod in self.card.products:
             prod.remaining_rides = 9999
         self.assertFalse(self.ride_rem._check_ride_reminder(self.card))
+
+    @silence_is_golden
+    def test_checks_accept_snapshot(self, *args):
+        self.card.pending = []
+        for prod in self.card.products:
+            prod.remaining_rides = 3
+        self.card.stored_value = 9.99
+
+        last_state = CardSnapshot.from_card(self.card)
+        self.assertFalse(self.ride_rem._check_ride_reminder(self.card, last_state=last_state))
+        self.assertFalse(self.round_trip_rem._check_round_trip_reminder(self.card, last_state=last_state))
+        self.assertFalse(self.bal_rem._check_balance_reminder(self.card, last_state))
+
+        self.card.products[0].remaining_rides = 1
+        self.card.stored_value = 5
+        self.assertTrue(self.ride_rem._check_ride_reminder(self.card, last_state=last_state))
+        self.assertTrue(self.round_trip_rem._check_round_trip_reminder(self.card, last_state=last_state))
+        self.assertTrue(self.bal_rem._check_balance_reminder(self.card, last_state))
+
+    def test_proximity(self):
+        now = datetime(year=1984, month=11, day=1)
+
+        # Balance is closer the nearer it gets to the threshold
+        self.card.stored_value = 80
+        far = self.bal_rem.proximity(self.card, now=now)
+        self.card.stored_value = 20.09
+        near = self.bal_rem.proximity(self.card, now=now)
+        self.assertTrue(0 < far < near < 1)
+        self.card.stored_value = 5
+        self.assertEqual(self.bal_rem.proximity(self.card, now=now), 1.0)
+
+        # Rides use the closest product
+        self.assertEqual(self.ride_rem.proximity(self.card, now=now), 1.0)
+        for prod in self.card.products:
+            prod.remaining_rides = 20
+        self.assertEqual(self.ride_rem.proximity(self.card, now=now), 0.25)
+        self.assertEqual(self.round_trip_rem.proximity(self.card, now=now), 0.3)
+
+        # Expirations decay by days until the reminder fires
+        self.exp_rem.quantifier = 'Days'
+        self.exp_rem.threshold = 2
+        self.card.products = []
+        self.card.expiration_date = datetime(year=1984, month=11, day=3)
+        self.assertEqual(self.exp_rem.proximity(self.card, now=now), 1.0)
+        self.card.expiration_date = datetime(year=1984, month=11, day=7)
+        self.assertEqual(self.exp_rem.proximity(self.card, now=now), 0.2)
+        self.card.expiration_date = datetime(year=1984, month=10, day=1)
+        self.assertEqual(self.exp_rem.proximity(self.card, now=now), 0.0)
+
+        # Expired reminders don't matter
+        self.bal_rem.valid_until = now
+        self.assertEqual(self.bal_rem.proximity(self.card, now=now), 0.0)
+
+    def test_next_fire_date(self):
+        now = datetime(year=1984, month=11, day=10)
+
+        # Two weeks ahead of the earliest product expiration
+        self.assertEqual(self.exp_rem.next_fire_date(self.card, now=now), date(1984, 11, 17))
+
+        # Only days after today
+        now = datetime(year=1984, month=11, day=17, hour=8)
+        self.assertEqual(self.exp_rem.next_fire_date(self.card, now=now), date(1984, 11, 18))
+
+        # Month lengths vary. Jan 29th through 31st plus a month are all Feb 28th
+        card = Mock(expiration_date=datetime(year=1985, month=2, day=28), products=[])
+        month_rem = Reminder(type='EXP', threshold=1, quantifier='months')
+        self.assertEqual(month_rem.next_fire_date(card, now=datetime(1985, 1, 1)), date(1985, 1, 28))
+
+        self.assertIsNone(self.exp_rem.next_fire_date(self.card, now=datetime(year=1984, month=12, day=2)))
+        self.assertIsNone(self.bal_rem.next_fire_date(self.card, now=now))
+
+    @patch('breezeminder.tasks.check_reminder_cards')
+    def test_queue_check_all_cards(self, mock_task):
+        self.bal_rem.id = ObjectId()
+        try:
+            self.assertTrue(self.bal_rem.queue_check_all_cards(delay=5))
+            self.assertFalse(self.bal_rem.queue_check_all_cards(delay=5))
+            mock_task.apply_async.assert_called_once_with(args=[self.bal_rem.id], countdown=5)
+        finally:
+            app.redis.delete(self.bal_rem.check_key)
+
+
+class ReminderEngineTestCase(TestCase):
+
+    def setUp(self):
+        self.card = Mock()
+        self.reminders = []
+        for key in ['BAL', 'EXP']:
+            reminder = Mock()
+            reminder.type_key = key
+            reminder.check_reminder.return_value = True
+            self.reminders.append(reminder)
+
+        self.engine = ReminderEngine(Mock(), reminders=self.reminders)
+        self.engine._recent = set()
+
+    @patch.object(ReminderEngine, '_insert')
+    @patch.object(ReminderEngine, 'compose')
+    @silence_is_golden
+    def test_run(self, mock_compose, mock_insert, *args):
+        mock_compose.return_value = (['message'], 'history')
+
+        self.assertEqual(self.engine.run([self.card]), 2)
+        self.assertEqual(mock_insert.call_args_list[0][0][1], ['message', 'message'])
+        self.assertEqual(mock_insert.call_args_list[1][0][1], ['history', 'history'])
+
+        # Both were reminded, so only forcing sends again
+        self.assertEqual(self.engine.run([self.card]), 0)
+        self.assertEqual(self.engine.run([self.card], force=True), 2)
+
+    @patch.object(ReminderEngine, '_insert')
+    @patch.object(ReminderEngine, 'compose')
+    @silence_is_golden
+    def test_run_types(self, mock_compose, mock_insert, *args):
+        mock_compose.return_value = ([], 'history')
+
+        self.assertEqual(self.engine.run([self.card], types=['EXP']), 1)
+        mock_compose.assert_called_once_with(self.reminders[1], self.card, None)
+
+    @patch.object(ReminderEngine, '_insert')
+    @patch.object(ReminderEngine, 'compose')
+    @silence_is_golden
+    def test_run_not_needed(self, mock_compose, mock_insert, *args):
+        for reminder in self.reminders:
+            reminder.check_reminder.return_value = False
+
+        self.assertEqual(self.engine.run([self.card]), 0)
+        self.assertFalse(mock_compose.called)
@@ -0,0 +1,8 @@
+from breezeminder.tests.util.test_balance import BalancePageParserTestCase
+from breezeminder.tests.util.test_scheduling import (DueQueueTestCase,
+                                                    SetOnceTestCase)
+from breezeminder.tests.util.test_throttle import (CircuitBreakerTestCase,
+                                                  ParseRateTestCase,
+                                                  TokenBucketTestCase)
+from breezeminder.tests.util.test_delivery import MailDeliveryTestCase
+from breezeminder.tests.util.test_date import QuietUntilTestCase
@@ -0,0 +1,72 @@
+import os
+
+from BeautifulSoup import BeautifulSoup
+from datetime import datetime
+from unittest2 import TestCase
+
+from breezeminder.models.card import BreezeCard
+from breezeminder.tests.models.test_card import (AUTOLOAD_CONTENT,
+                                                 EMPTY_CONTENT,
+                                                 FAKE_CONTENT,
+                                                 FAKE_CONTENT_INVALID,
+                                                 PRODUCT_CONTENT)
+from breezeminder.util.balance import parse_balance_page
+from breezeminder.util.testing import silence_is_golden
+
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                            'lib', 'example_output.html')
+
+
+class BalancePageParserTestCase(TestCase):
+
+    def setUp(self):
+        self.card = BreezeCard()
+
+    def _soup_parse(self, content):
+        soup = BeautifulSoup(content)
+        return {
+            'expiration_date': self.card._parse_expiration_date(soup),
+            'stored_value': self.card._parse_stored_value(soup),
+            'products': self.card._parse_products(soup),
+            'pending': self.card._parse_pending_transactions(soup),
+        }
+
+    @silence_is_golden
+    def test_matches_soup_parsing(self, *args):
+        with open(EXAMPLE_FILE, 'r') as f:
+            example = f.read()
+
+        for content in [example, EMPTY_CONTENT, FAKE_CONTENT, FAKE_CONTENT_INVALID,
+                        PRODUCT_CONTENT, AUTOLOAD_CONTENT]:
+            self.assertEquals(self._soup_parse(content), parse_balance_page(content))
+
+    def test_example_output(self):
+        with open(EXAMPLE_FILE, 'r') as f:
+            parsed = parse_balance_page(f.read())
+
+        self.assertEquals(datetime(year=2022, month=6, day=17), parsed['expiration_date'])
+        self.assertEquals('0.00', parsed['stored_value'])
+        self.assertEquals([{'name': 'CB Exp 31D',
+                            'remaining_rides': None,
+                            'expiration_date': datetime(year=2012, month=8, day=5)}],
+                          parsed['products'])
+        self.assertEquals([], parsed['pending'])
+
+    def test_first_match_only(self):
+        content = FAKE_CONTENT.replace('</table>',
+                                       '<tr><td>Stored Value</td><td>$1.00</td></tr></table>')
+        self.assertEquals('100.00', parse_balance_page(content)['stored_value'])
+
+    def test_nested_cells(self):
+        content = """
+        <table>
+            <tr><td>pending autoload transactions</td></tr>
+            <tr><td><table><tr><td>Foo</td></tr></table></td></tr>
+            <tr><td>Bar</td></tr>
+        </table>
+        """
+
+        # Nested cells count towards the row just like findChildren('td')
+        self.assertEquals([{'name': 'Foo', 'value': 0.0}],
+                          parse_balance_page(content)['pending'])
@@ -0,0 +1,29 @@
+from datetime import datetime
+from unittest2 import TestCase
+
+from breezeminder.util.date import quiet_until
+
+
+class QuietUntilTestCase(TestCase):
+
+    def test_outside_quiet_hours(self):
+        when = datetime(2012, 6, 1, 12, 30)
+        self.assertEqual(quiet_until(when, 23, 7), when)
+        self.assertEqual(quiet_until(when, 1, 6), when)
+
+    def test_no_quiet_hours(self):
+        when = datetime(2012, 6, 1, 23, 30)
+        self.assertEqual(quiet_until(when, None, None), when)
+        self.assertEqual(quiet_until(when, 7, 7), when)
+
+    def test_wraps_past_midnight(self):
+        self.assertEqual(quiet_until(datetime(2012, 6, 1, 23, 30), 23, 7),
+                         datetime(2012, 6, 2, 7))
+        self.assertEqual(quiet_until(datetime(2012, 6, 2, 3, 15), 23, 7),
+                         datetime(2012, 6, 2, 7))
+        self.assertEqual(quiet_until(datetime(2012, 6, 2, 7), 23, 7),
+                         datetime(2012, 6, 2, 7))
+
+    def test_same_day(self):
+        self.assertEqual(quiet_until(datetime(2012, 6, 1, 13, 45), 12, 14),
+                         datetime(2012, 6, 1, 14))
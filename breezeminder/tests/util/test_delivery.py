@@ -0,0 +1,67 @@
+import smtplib
+
+from flaskext.mail import Mail, Message
+from mock import MagicMock, patch
+from unittest2 import TestCase
+
+from breezeminder.app import app
+from breezeminder.util.delivery import MailDelivery
+from breezeminder.util.testing import LocalSMTPServer, silence_is_golden
+
+
+def _message(i):
+    return Message(subject='Message %s' % i,
+                   sender='no-reply@foo.com',
+                   recipients=['foo@bar.com'],
+                   body='Bar')
+
+
+class MailDeliveryTestCase(TestCase):
+
+    def setUp(self):
+        self.server = LocalSMTPServer().start()
+        self.mail = self.server.configure(Mail(app))
+
+    def tearDown(self):
+        self.server.stop()
+
+    @silence_is_golden
+    def test_deliver(self, *args):
+        delivery = MailDelivery(self.mail, workers=2)
+        sent = delivery.deliver((i, _message(i)) for i in range(10))
+
+        self.assertEqual(sorted(sent), range(10))
+        self.assertEqual(len(self.server.received), 10)
+
+    @silence_is_golden
+    def test_deliver_reuses_connections(self, *args):
+        delivery = MailDelivery(self.mail, workers=2)
+
+        with patch.object(MailDelivery, 'connect', side_effect=delivery.connect) as mock_connect:
+            delivery.deliver((i, _message(i)) for i in range(10))
+            self.assertTrue(mock_connect.call_count <= 2)
+
+    @silence_is_golden
+    def test_deliver_nothing(self, *args):
+        self.assertEqual(MailDelivery(self.mail).deliver([]), [])
+
+    @patch.object(app.logger, 'warning')
+    def test_reconnect(self, *args):
+        dropped = MagicMock()
+        dropped.send.side_effect = smtplib.SMTPServerDisconnected()
+        delivery = MailDelivery(self.mail)
+
+        with patch.object(MailDelivery, 'connect', side_effect=[dropped, delivery.connect()]):
+            self.assertEqual(delivery.deliver([(1, _message(1))]), [1])
+
+        self.assertTrue(dropped.__exit__.called)
+        self.assertEqual(len(self.server.received), 1)
+
+    @silence_is_golden
+    def test_failures_left_out(self, *args):
+        broken = MagicMock()
+        broken.send.side_effect = smtplib.SMTPRecipientsRefused({})
+        delivery = MailDelivery(self.mail)
+
+        with patch.object(MailDelivery, 'connect', return_value=broken):
+            self.assertEqual(delivery.deliver([(1, _message(1))]), [])
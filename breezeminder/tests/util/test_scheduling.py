@@ -0,0 +1,105 @@
+import time
+
+from datetime import datetime
+from mock import Mock, patch
+from unittest2 import TestCase
+
+from breezeminder.util.scheduling import DueQueue, set_once, to_timestamp
+
+
+class DueQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.redis = Mock()
+        self.queue = DueQueue(self.redis, 'due')
+
+    def test_to_timestamp(self):
+        now = datetime.now()
+        self.assertAlmostEqual(to_timestamp(now), time.mktime(now.timetuple()) + now.microsecond / 1e6)
+
+    def test_schedule(self):
+        when = datetime(2012, 6, 1, 12, 0, 0)
+        self.queue.schedule(1234, when)
+        self.redis.zadd.assert_called_once_with('due', **{'1234': to_timestamp(when)})
+
+    def test_schedule_many_empty(self):
+        self.queue.schedule_many({})
+        self.assertFalse(self.redis.zadd.called)
+
+    def test_remove(self):
+        self.queue.remove(1, 2)
+        self.redis.zrem.assert_called_once_with('due', '1', '2')
+
+    @patch('breezeminder.util.scheduling.time.time')
+    def test_claim_leases(self, mock_time):
+        mock_time.return_value = 1000.0
+        pipe = Mock()
+        pipe.zrangebyscore.return_value = ['a', 'b']
+        self.redis.transaction.side_effect = lambda func, *watches: func(pipe)
+
+        self.assertEqual(self.queue.claim(10, lease=60), ['a', 'b'])
+        self.assertEqual(self.redis.transaction.call_args[0][1:], ('due', ))
+        pipe.zrangebyscore.assert_called_once_with('due', '-inf', 1000.0, start=0, num=10)
+        pipe.zadd.assert_called_once_with('due', a=1060.0, b=1060.0)
+
+    def test_claim_nothing_due(self):
+        pipe = Mock()
+        pipe.zrangebyscore.return_value = []
+        self.redis.transaction.side_effect = lambda func, *watches: func(pipe)
+
+        self.assertEqual(self.queue.claim(10, lease=60), [])
+        self.assertFalse(pipe.zadd.called)
+
+    def test_claim_ranked(self):
+        pipe = Mock()
+        pipe.zrangebyscore.return_value = ['a', 'b', 'c', 'd']
+        self.redis.transaction.side_effect = lambda func, *watches: func(pipe)
+        rank = {'a': 0.1, 'b': 0.9, 'c': 0.1, 'd': 0.5}
+
+        self.assertEqual(self.queue.claim(3, lease=60, window=8, rank=rank.get), ['b', 'd', 'a'])
+        self.assertEqual(pipe.zrangebyscore.call_args[1]['num'], 8)
+
+    @patch('breezeminder.util.scheduling.time.time')
+    def test_claim_held(self, mock_time):
+        mock_time.return_value = 1000.0
+        pipe = Mock()
+        due = ['a', 'b', 'c']
+        held = ['b']
+        pipe.zrangebyscore.side_effect = lambda key, *args, **kwargs: due if key == 'due' else held
+        self.redis.transaction.side_effect = lambda func, *watches: func(pipe)
+
+        # Held members are leased again but not handed out
+        self.assertEqual(self.queue.claim(10, lease=60, hold=600), ['a', 'c'])
+        self.assertEqual(self.redis.transaction.call_args[0][1:], ('due', 'due:held'))
+        pipe.zadd.assert_any_call('due', a=1060.0, b=1060.0, c=1060.0)
+        pipe.zadd.assert_any_call('due:held', a=1600.0, c=1600.0)
+        pipe.zremrangebyscore.assert_called_once_with('due:held', '-inf', 1000.0)
+
+    def test_count(self):
+        self.redis.zcard.return_value = 3
+        self.assertEqual(self.queue.count(), 3)
+        self.redis.zcard.assert_called_once_with('due')
+
+    def test_release(self):
+        self.queue.release(1, 2)
+        self.redis.zrem.assert_called_once_with('due:held', '1', '2')
+
+
+class SetOnceTestCase(TestCase):
+
+    def setUp(self):
+        self.redis = Mock()
+        self.pipe = Mock()
+        self.redis.transaction.side_effect = lambda func, *watches: func(self.pipe)
+
+    def test_sets_with_ttl(self):
+        self.pipe.exists.return_value = False
+        self.assertTrue(set_once(self.redis, 'key', 60))
+        self.assertEqual(self.redis.transaction.call_args[0][1:], ('key',))
+        self.pipe.setex.assert_called_once_with('key', 1, 60)
+
+    def test_existing_key(self):
+        self.pipe.exists.return_value = True
+        self.assertFalse(set_once(self.redis, 'key', 60))
+        self.assertFalse(self.pipe.setex.called)
+        self.assertFalse(self.pipe.expire.called)
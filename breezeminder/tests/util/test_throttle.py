@@ -0,0 +1,109 @@
+from mock import patch
+from unittest2 import TestCase
+
+from breezeminder.util.throttle import (CircuitBreaker,
+                                        CircuitOpen,
+                                        TokenBucket,
+                                        parse_rate)
+
+
+class ParseRateTestCase(TestCase):
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('10/s'), 10.0)
+        self.assertEqual(parse_rate('60/m'), 1.0)
+        self.assertEqual(parse_rate('3600/h'), 1.0)
+        self.assertEqual(parse_rate('5'), 5.0)
+        self.assertEqual(parse_rate(2), 2.0)
+
+
+@patch('breezeminder.util.throttle.time.time')
+class TokenBucketTestCase(TestCase):
+
+    def test_burst(self, mock_time):
+        mock_time.return_value = 1000.0
+        bucket = TokenBucket('60/m', capacity=3)
+
+        self.assertEqual([bucket.take() for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(), 1.0)
+
+    def test_refill(self, mock_time):
+        mock_time.return_value = 1000.0
+        bucket = TokenBucket('60/m', capacity=2)
+        bucket.take(2)
+
+        mock_time.return_value = 1001.0
+        self.assertEqual(bucket.take(), 0)
+        self.assertTrue(bucket.take() > 0)
+
+        # Never refills past capacity
+        mock_time.return_value = 2000.0
+        self.assertEqual(bucket.take(2), 0)
+        self.assertTrue(bucket.take() > 0)
+
+    def test_acquire_timeout(self, mock_time):
+        mock_time.return_value = 1000.0
+        bucket = TokenBucket('1/m', capacity=1)
+
+        self.assertTrue(bucket.acquire(timeout=1))
+        self.assertFalse(bucket.acquire(timeout=1))
+
+    def test_reserve(self, mock_time):
+        mock_time.return_value = 1000.0
+        bucket = TokenBucket('60/m', capacity=3)
+
+        # Background callers leave one token behind, urgent callers don't
+        self.assertEqual([bucket.take(reserve=1) for i in range(2)], [0, 0])
+        self.assertAlmostEqual(bucket.take(reserve=1), 1.0)
+        self.assertEqual(bucket.take(), 0)
+        self.assertAlmostEqual(bucket.take(), 1.0)
+
+
+@patch('breezeminder.util.throttle.time.time')
+class CircuitBreakerTestCase(TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(window=60, min_calls=4, threshold=0.5, slow=5, pause=300)
+
+    def test_trips_on_errors(self, mock_time):
+        mock_time.return_value = 1000.0
+
+        self.assertFalse(self.breaker.record(1, failed=True))
+        self.assertFalse(self.breaker.record(1))
+        self.assertFalse(self.breaker.record(1))
+        self.assertTrue(self.breaker.record(1, failed=True))
+        self.assertFalse(self.breaker.allow())
+
+        # Closes again once the pause is over
+        mock_time.return_value = 1301.0
+        self.assertTrue(self.breaker.allow())
+
+    def test_trips_on_latency(self, mock_time):
+        mock_time.return_value = 1000.0
+
+        for i in range(2):
+            self.breaker.record(1)
+        for i in range(2):
+            self.breaker.record(10)
+
+        self.assertFalse(self.breaker.allow())
+
+    def test_old_windows_expire(self, mock_time):
+        mock_time.return_value = 1000.0
+        for i in range(3):
+            self.breaker.record(1, failed=True)
+
+        mock_time.return_value = 1200.0
+        self.assertFalse(self.breaker.record(1, failed=True))
+        self.assertTrue(self.breaker.allow())
+
+    def test_call(self, mock_time):
+        mock_time.return_value = 1000.0
+        self.assertEqual(self.breaker.call(lambda x: x * 2, 2), 4)
+
+        def fail():
+            raise ValueError()
+
+        for i in range(3):
+            self.assertRaises(ValueError, self.breaker.call, fail)
+        self.assertRaises(CircuitOpen, self.breaker.call, fail)
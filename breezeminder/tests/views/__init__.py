@@ -0,0 +1 @@
+from breezeminder.tests.views.test_marta import RouteRealtimeTestCase
@@ -0,0 +1,46 @@
+from mock import patch
+from unittest2 import TestCase
+
+import breezeminder.views
+
+from breezeminder.app import app
+from breezeminder.models.marta import live_buses
+
+
+class RouteRealtimeTestCase(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.headers = {'Referer': 'http://localhost/marta/'}
+
+    def _get(self, **headers):
+        headers.update(self.headers)
+        return self.client.get('/marta/realtime/110.json', headers=headers)
+
+    @patch.object(live_buses, 'snapshot')
+    def test_etag(self, mock_snapshot):
+        mock_snapshot.return_value = ('abc.1', '[{"id": "1234"}]')
+
+        resp = self._get()
+        self.assertEquals(200, resp.status_code)
+        self.assertEquals('"110-abc.1"', resp.headers['ETag'])
+        self.assertEquals('[{"id": "1234"}]', resp.data)
+        mock_snapshot.assert_called_once_with('110')
+
+    @patch.object(live_buses, 'snapshot')
+    def test_not_modified(self, mock_snapshot):
+        mock_snapshot.return_value = ('abc.1', '[{"id": "1234"}]')
+
+        resp = self._get(**{'If-None-Match': '"110-abc.1"'})
+        self.assertEquals(304, resp.status_code)
+        self.assertEquals('', resp.data)
+        self.assertEquals('"110-abc.1"', resp.headers['ETag'])
+
+    @patch.object(live_buses, 'snapshot')
+    def test_modified(self, mock_snapshot):
+        mock_snapshot.return_value = ('abc.2', '[]')
+
+        resp = self._get(**{'If-None-Match': '"110-abc.1"'})
+        self.assertEquals(200, resp.status_code)
+        self.assertEquals('"110-abc.2"', resp.headers['ETag'])
+        self.assertEquals('[]', resp.data)
@@ -0,0 +1,319 @@
+"""
+Single pass extraction of card details from the breeze card balance page.
+
+This is a streaming replacement for building a full BeautifulSoup tree and
+searching it several times. Element nesting follows the same rules as
+BeautifulSoup 3 so that the extracted values are identical.
+"""
+import re
+
+from datetime import datetime
+from HTMLParser import HTMLParser, HTMLParseError
+
+
+_date_pat = re.compile(r'\d{2}-\d{2}-\d{4}')
+
+EXPIRATION_PAT = re.compile(r'your card will expire', re.I)
+STORED_VALUE_PAT = re.compile(r'stored value', re.I)
+PRODUCTS_PAT = re.compile(r'product name', re.I)
+PENDING_PAT = re.compile(r'pending autoload transactions', re.I)
+
+
+# Nesting rules borrowed from BeautifulSoup 3
+SELF_CLOSING_TAGS = frozenset(['br', 'hr', 'input', 'img', 'meta',
+                               'spacer', 'link', 'frame', 'base', 'col'])
+
+NESTABLE_TAGS = {
+    'span': [], 'font': [], 'q': [], 'object': [], 'bdo': [], 'sub': [],
+    'sup': [], 'center': [],
+    'blockquote': [], 'div': [], 'fieldset': [], 'ins': [], 'del': [],
+    'ol': [], 'ul': [], 'li': ['ul', 'ol'], 'dl': [], 'dd': ['dl'], 'dt': ['dl'],
+    'table': [], 'tr': ['table', 'tbody', 'tfoot', 'thead'], 'td': ['tr'],
+    'th': ['tr'], 'thead': ['table'], 'tbody': ['table'], 'tfoot': ['table'],
+}
+
+RESET_NESTING_TAGS = frozenset(['blockquote', 'div', 'fieldset', 'ins', 'del',
+                                'noscript', 'address', 'form', 'p', 'pre',
+                                'ol', 'ul', 'li', 'dl', 'dd', 'dt',
+                                'table', 'tr', 'td', 'th', 'thead', 'tbody', 'tfoot'])
+
+
+def _parse_date(value):
+    return datetime.strptime(_date_pat.findall(value)[0], '%m-%d-%Y')
+
+
+class _Element(object):
+    """ An open tag. Only tags we care about collect text or cells """
+    __slots__ = ('name', 'parent', 'strings', 'cells')
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.strings = None
+        self.cells = None
+
+    @property
+    def text(self):
+        return u''.join(self.strings)
+
+
+class _Watch(object):
+    """
+    Watches for tags that are later siblings of ``after``. Each sibling
+    is handed to ``callback`` once closed, which returns False to stop watching
+    """
+    __slots__ = ('container', 'callback', 'collect_cells')
+
+    def __init__(self, after, callback, collect_cells=False):
+        self.container = after.parent
+        self.callback = callback
+        self.collect_cells = collect_cells
+
+
+class BalancePageParser(HTMLParser):
+    """
+    Streams over a balance page once, collecting the card expiration date,
+    stored value, products and pending autoload transactions
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.root = _Element(None, None)
+        self.stack = [self.root]
+        self.data = []
+        self.watches = []
+        self.siblings = {}
+        self.capturing = []
+
+        self.expiration_date = None
+        self.stored_value = None
+        self.products = []
+        self.pending = []
+        self.markers = set()
+
+    def results(self):
+        return {
+            'expiration_date': self.expiration_date,
+            'stored_value': self.stored_value,
+            'products': self.products,
+            'pending': self.pending,
+        }
+
+    # Tree building
+    def handle_starttag(self, tag, attrs):
+        self.end_data()
+
+        if tag not in SELF_CLOSING_TAGS:
+            self.smart_pop(tag)
+
+        parent = self.stack[-1]
+        element = _Element(tag, parent)
+
+        # Any td is a cell of every watched sibling it is nested in
+        if tag == 'td':
+            for sibling in self.capturing:
+                if sibling.cells is not None:
+                    sibling.cells.append(element)
+            if self.capturing:
+                element.strings = []
+                self.capturing.append(element)
+
+        for watch in self.watches:
+            if watch.container is parent:
+                if watch.collect_cells:
+                    element.cells = []
+                if element.strings is None:
+                    element.strings = []
+                    self.capturing.append(element)
+                self.siblings.setdefault(id(element), []).append(watch)
+
+        self.stack.append(element)
+
+        if tag in SELF_CLOSING_TAGS:
+            self.pop()
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in SELF_CLOSING_TAGS:
+            self.pop()
+
+    def handle_endtag(self, tag):
+        self.end_data()
+        self.pop_to(tag)
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_entityref(self, name):
+        self.data.append(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        self.data.append(u'&#%s;' % name)
+
+    def handle_comment(self, data):
+        self.end_data()
+        self.data.append(data)
+        self.end_data()
+
+    def handle_decl(self, decl):
+        self.end_data()
+
+    def handle_pi(self, data):
+        self.end_data()
+
+    def close(self):
+        HTMLParser.close(self)
+        self.end_data()
+        while len(self.stack) > 1:
+            self.pop()
+
+    def smart_pop(self, name):
+        """ See BeautifulSoup._smartPop """
+        triggers = NESTABLE_TAGS.get(name)
+        is_nestable = triggers is not None
+        is_reset = name in RESET_NESTING_TAGS
+
+        for element in reversed(self.stack[1:]):
+            if element.name == name and not is_nestable:
+                self.pop_to(name)
+                return
+            if (triggers is not None and element.name in triggers) or \
+                    (triggers is None and is_reset and element.name in RESET_NESTING_TAGS):
+                self.pop_to(element.name, inclusive=False)
+                return
+
+    def pop_to(self, name, inclusive=True):
+        """ See BeautifulSoup._popToTag """
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].name == name:
+                count = len(self.stack) - i
+                if not inclusive:
+                    count -= 1
+                for _ in range(count):
+                    self.pop()
+                return
+
+    def pop(self):
+        element = self.stack.pop()
+
+        if element.strings is not None:
+            self.capturing.remove(element)
+
+        for watch in self.siblings.pop(id(element), []):
+            if watch in self.watches and watch.callback(element) is False:
+                self.watches.remove(watch)
+
+        # Once the container closes there are no more siblings
+        self.watches = [w for w in self.watches if w.container is not element]
+
+    def end_data(self):
+        if not self.data:
+            return
+
+        text = u''.join(self.data)
+        self.data = []
+
+        stripped = text.strip()
+        for element in self.capturing:
+            element.strings.append(stripped)
+
+        if stripped and len(self.markers) < 4:
+            self.search(text, self.stack[-1])
+
+    # Extraction
+    def search(self, text, parent):
+        """ Only the first text matching a marker is ever considered """
+        if 'expiration' not in self.markers and EXPIRATION_PAT.search(text):
+            self.markers.add('expiration')
+            try:
+                self.expiration_date = _parse_date(text)
+            except (IndexError, ValueError):
+                pass
+
+        if 'stored_value' not in self.markers and STORED_VALUE_PAT.search(text):
+            self.markers.add('stored_value')
+            if parent.parent is not None:
+                self.watches.append(_Watch(parent, self.on_stored_value))
+
+        if 'products' not in self.markers and PRODUCTS_PAT.search(text):
+            self.markers.add('products')
+            if parent.parent is not None and parent.parent.parent is not None:
+                self.watches.append(_Watch(parent.parent, self.on_product_row,
+                                           collect_cells=True))
+
+        if 'pending' not in self.markers and PENDING_PAT.search(text):
+            self.markers.add('pending')
+            if parent.parent is not None and parent.parent.parent is not None:
+                self.watches.append(_Watch(parent.parent, self.on_pending_row,
+                                           collect_cells=True))
+
+    def on_stored_value(self, element):
+        self.stored_value = element.text.replace('$', '').strip() or None
+        return False
+
+    def on_product_row(self, row):
+        if len(row.cells) != 3:
+            return False
+
+        product = {
+            'name': row.cells[0].text.strip(),
+            'remaining_rides': None,
+            'expiration_date': None,
+        }
+
+        if 'no active product' in product['name'].lower():
+            return True
+
+        try:
+            product['remaining_rides'] = int(row.cells[2].text.strip())
+        except ValueError:
+            pass
+
+        try:
+            product['expiration_date'] = _parse_date(row.cells[1].text.strip())
+        except (IndexError, ValueError):
+            pass
+
+        self.products.append(product)
+        return True
+
+    def on_pending_row(self, row):
+        if len(row.cells) != 2:
+            return False
+
+        transaction = {
+            'name': row.cells[0].text.strip(),
+            'value': row.cells[1].text.strip()
+        }
+
+        # Skip if it's just a header
+        if transaction['name'].lower() in ['product name', '&nbsp;']:
+            return True
+
+        try:
+            transaction['value'] = float(transaction['value'].replace('$', ''))
+        except ValueError:
+            transaction['value'] = 0.0
+
+        self.pending.append(transaction)
+        return True
+
+
+def parse_balance_page(content):
+    """
+    Parses a balance page, returning a dict of ``expiration_date``,
+    ``stored_value``, ``products`` and ``pending``. The page is served
+    as iso-8859-1
+    """
+    if isinstance(content, str):
+        content = content.decode('iso-8859-1')
+
+    parser = BalancePageParser()
+    try:
+        parser.feed(content)
+        parser.close()
+    except HTMLParseError:
+        # Keep whatever was found before the markup went bad
+        pass
+
+    return parser.results()
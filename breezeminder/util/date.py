@@ -23,3 +23,26 @@ def timesince(dt, default="Just Now"):
         if period:
             return "%d %s Ago" % (period, singular if period == 1 else plural)
     return default
+
+
+def quiet_until(when, start, end):
+    """
+    Returns the earliest time at or after ``when`` that is outside of
+    quiet hours running from hour ``start`` up to hour ``end``. Quiet
+    hours may wrap past midnight, e.g. 22 to 7
+    """
+    if start is None or end is None or start == end:
+        return when
+
+    if start < end:
+        quiet = start <= when.hour < end
+    else:
+        quiet = when.hour >= start or when.hour < end
+
+    if not quiet:
+        return when
+
+    resume = when.replace(hour=end, minute=0, second=0, microsecond=0)
+    if resume <= when:
+        resume += datetime.timedelta(days=1)
+    return resume
@@ -0,0 +1,103 @@
+import Queue
+import smtplib
+import socket
+import threading
+
+from flaskext.mail import Connection
+
+from breezeminder.app import app
+
+
+class MailDelivery(object):
+    """
+    Sends batches of mail over a small pool of persistent SMTP connections.
+    Each worker thread opens one connection the first time it sends and keeps
+    it for the rest of the batch, reconnecting once if the server drops it
+    """
+
+    def __init__(self, mail, workers=1):
+        self.mail = mail
+        self.workers = workers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def connect(self):
+        """ Opens a new connection. Flask-Mail connects on enter """
+        return Connection(self.mail).__enter__()
+
+    def connection(self, reconnect=False):
+        """ This thread's connection, opened if there isn't one yet """
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is not None and reconnect:
+            with self._lock:
+                self._connections.remove(conn)
+            self._close(conn)
+            conn = None
+
+        if conn is None:
+            conn = self._local.conn = self.connect()
+            with self._lock:
+                self._connections.append(conn)
+
+        return conn
+
+    def send(self, message):
+        """ Sends a :class:`flaskext.mail.Message`, reconnecting once if the connection was lost """
+        try:
+            self.connection().send(message)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            app.logger.warning('Lost the SMTP connection. Reconnecting')
+            self.connection(reconnect=True).send(message)
+
+    def deliver(self, messages):
+        """
+        Sends an iterable of (key, message) pairs and closes the connections.
+        Returns the keys of messages that were sent. Messages that fail are
+        logged and left out
+        """
+        queue = Queue.Queue()
+        for item in messages:
+            queue.put(item)
+
+        sent = []
+
+        def work():
+            while True:
+                try:
+                    key, message = queue.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    self.send(message)
+                    sent.append(key)
+                except Exception:
+                    app.logger.exception('Failed to send message %s' % key)
+
+        # Plain threads, a ThreadPool takes up to 100ms to join
+        threads = [threading.Thread(target=work) for i in range(min(queue.qsize(), self.workers))]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.close()
+
+        return sent
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+
+        for conn in connections:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.__exit__(None, None, None)
+        except Exception:
+            # Already gone. Nothing to say goodbye to
+            pass
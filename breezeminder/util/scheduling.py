@@ -0,0 +1,113 @@
+import time
+
+
+def to_timestamp(value):
+    """ Unix timestamp of a naive local datetime """
+    return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+
+def set_once(redis, key, timeout, value=1):
+    """
+    Sets ``key`` to expire in ``timeout`` seconds unless it already exists.
+    Both happen in one transaction, so the key is never left without its
+    TTL and an existing key keeps the TTL it has. Returns True if it was set
+    """
+    created = []
+
+    def create(pipe):
+        created[:] = [not pipe.exists(key)]
+        pipe.multi()
+        if created[0]:
+            pipe.setex(key, value, timeout)
+
+    redis.transaction(create, key)
+    return created[0]
+
+
+class DueQueue(object):
+    """
+    A redis sorted set of members scored by the unix time they are next due.
+    Claimed members are leased rather than removed, so if a worker dies the
+    member simply becomes due again once its lease runs out. Claims may also
+    be held until released, so that a slow consumer doesn't get a member
+    handed out twice
+    """
+
+    def __init__(self, redis, key):
+        self.redis = redis
+        self.key = key
+        self.held_key = '%s:held' % key
+
+    def schedule(self, member, when):
+        """ Sets the datetime ``member`` is next due """
+        self.schedule_many({member: when})
+
+    def schedule_many(self, members):
+        """ Sets due datetimes from a dict of member -> datetime """
+        if members:
+            scores = dict((str(member), to_timestamp(when))
+                          for member, when in members.iteritems())
+            self.redis.zadd(self.key, **scores)
+
+    def remove(self, *members):
+        if members:
+            self.redis.zrem(self.key, *[str(m) for m in members])
+
+    def release(self, *members):
+        """ Lets held members be claimed again once due """
+        if members:
+            self.redis.zrem(self.held_key, *[str(m) for m in members])
+
+    def due_at(self, member):
+        return self.redis.zscore(self.key, str(member))
+
+    def count(self):
+        return self.redis.zcard(self.key)
+
+    def count_due(self):
+        return self.redis.zcount(self.key, '-inf', time.time())
+
+    def peek(self, limit):
+        """ The ``limit`` longest overdue members, without claiming them """
+        return self.redis.zrangebyscore(self.key, '-inf', time.time(), start=0, num=limit)
+
+    def claim(self, limit, lease, window=None, rank=None, hold=None):
+        """
+        Claims up to ``limit`` due members by pushing each back ``lease``
+        seconds. Returns the list of claimed members.
+
+        By default the oldest are claimed. Given a ``rank`` function, the
+        ``window`` oldest members are sorted by it, highest first, and the
+        top ``limit`` are claimed. Ties keep the oldest first.
+
+        Given ``hold``, claimed members are also held for up to ``hold``
+        seconds or until released. A held member whose lease runs out is
+        leased again rather than claimed a second time
+        """
+        claimed = []
+        watches = [self.key] if hold is None else [self.key, self.held_key]
+
+        def lease_due(pipe):
+            now = time.time()
+            due = pipe.zrangebyscore(self.key, '-inf', now, start=0, num=max(limit, window or 0))
+
+            held = []
+            if hold is not None:
+                held = set(pipe.zrangebyscore(self.held_key, now, '+inf'))
+                held, due = [m for m in due if m in held], [m for m in due if m not in held]
+
+            if rank is not None:
+                due = sorted(due, key=rank, reverse=True)
+            due = due[:limit]
+            claimed[:] = due
+
+            pipe.multi()
+            if due or held:
+                pipe.zadd(self.key, **dict((member, now + lease) for member in due + held))
+            if hold is not None:
+                pipe.zremrangebyscore(self.held_key, '-inf', now)
+                if due:
+                    pipe.zadd(self.held_key, **dict((member, now + hold) for member in due))
+
+        self.redis.transaction(lease_due, *watches)
+        return claimed
@@ -1,4 +1,7 @@
+import asyncore
 import functools
+import smtpd
+import threading
 from mock import patch
 
 from breezeminder.app import app
@@ -15,3 +18,52 @@ def silence_is_golden(fn):
         return fn(*args, **kwargs)
 
     return without_logger_noise
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """
+    Stand-in SMTP server on a free local port that keeps every message it
+    receives. Serves from a background thread between start() and stop()
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.received = []
+        self._running = False
+        self._thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.close()
+
+        # Close any client channels left open
+        for channel in asyncore.socket_map.values():
+            if isinstance(channel, smtpd.SMTPChannel):
+                channel.close()
+
+    def configure(self, mail):
+        """ Points a :class:`flaskext.mail.Mail` at this server """
+        mail.server = '127.0.0.1'
+        mail.port = self.port
+        mail.use_tls = mail.use_ssl = False
+        mail.username = mail.password = None
+        mail.suppress = False
+        mail.fail_silently = False
+        mail.max_emails = None
+        return mail
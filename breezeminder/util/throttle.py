@@ -0,0 +1,230 @@
+"""
+Rate limiting and circuit breaking for calls to remote services.
+
+Each class keeps its state in process, which is enough for a single worker.
+The Redis* subclasses keep the same state in redis so that every worker
+process draws from one budget and trips one breaker.
+"""
+import threading
+import time
+
+
+RATE_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60}
+
+
+def parse_rate(rate):
+    """ Converts a celery style rate such as '10/m' to calls per second """
+    if isinstance(rate, basestring):
+        count, _, unit = rate.partition('/')
+        return float(count) / RATE_UNITS[unit or 's']
+    return float(rate)
+
+
+class Throttled(Exception):
+    """ Raised when a call could not be made within its rate limit """
+    pass
+
+
+class CircuitOpen(Throttled):
+    """ Raised when calls are paused because the remote service is unhealthy """
+    pass
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` calls per second on average, with bursts of up to
+    ``capacity`` calls. Callers may ask to leave a ``reserve`` of tokens
+    in the bucket, which keeps them available for more urgent callers
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = parse_rate(rate)
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._tokens = float(capacity)
+        self._stamp = time.time()
+
+    def _refill(self, tokens, stamp, now):
+        return min(self.capacity, tokens + max(0, now - stamp) * self.rate)
+
+    def _take(self, tokens, count, reserve=0):
+        """ Returns (remaining tokens, seconds to wait). No wait means success """
+        if tokens - reserve >= count:
+            return tokens - count, 0
+        return tokens, (count + reserve - tokens) / self.rate
+
+    def take(self, count=1, reserve=0):
+        """
+        Takes ``count`` tokens if they are available without dipping into
+        ``reserve``. Returns 0 on success, otherwise the number of seconds
+        until they would be
+        """
+        with self._lock:
+            now = time.time()
+            tokens = self._refill(self._tokens, self._stamp, now)
+            self._tokens, wait = self._take(tokens, count, reserve)
+            self._stamp = now
+        return wait
+
+    def acquire(self, count=1, timeout=None, reserve=0):
+        """
+        Blocks until ``count`` tokens are taken. Returns False if that would
+        take longer than ``timeout`` seconds
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            wait = self.take(count, reserve)
+            if not wait:
+                return True
+            if deadline is not None and time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class RedisTokenBucket(TokenBucket):
+    """ A TokenBucket shared by every process using the same redis key """
+
+    def __init__(self, redis, key, rate, capacity=1):
+        super(RedisTokenBucket, self).__init__(rate, capacity)
+        self.redis = redis
+        self.key = key
+
+    def take(self, count=1, reserve=0):
+        result = []
+
+        def refill(pipe):
+            now = time.time()
+            tokens, stamp = pipe.hmget(self.key, ['tokens', 'stamp'])
+
+            if tokens is None or stamp is None:
+                tokens = float(self.capacity)
+            else:
+                tokens = self._refill(float(tokens), float(stamp), now)
+
+            tokens, wait = self._take(tokens, count, reserve)
+            result[:] = [wait]
+
+            # Once idle long enough to refill, the key is the same as no key
+            pipe.multi()
+            pipe.hmset(self.key, {'tokens': tokens, 'stamp': now})
+            pipe.expire(self.key, int(self.capacity / self.rate) + 1)
+
+        self.redis.transaction(refill, self.key)
+        return result[0]
+
+
+class CircuitBreaker(object):
+    """
+    Counts calls, errors and slow calls over a sliding ``window`` of seconds.
+    Once at least ``min_calls`` were made and the share of errors or slow
+    calls reaches ``threshold``, calls are paused for ``pause`` seconds
+    """
+
+    def __init__(self, window=60, min_calls=10, threshold=0.5, slow=10, pause=300):
+        self.window = window
+        self.min_calls = min_calls
+        self.threshold = threshold
+        self.slow = slow
+        self.pause = pause
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._opened_until = 0
+
+    def _bucket(self, now):
+        return int(now // self.window)
+
+    def _count(self, fields, now):
+        """ Adds to this window's counters, returning totals for this and the last window """
+        bucket = self._bucket(now)
+        with self._lock:
+            for key in self._buckets.keys():
+                if key < bucket - 1:
+                    del self._buckets[key]
+
+            counts = self._buckets.setdefault(bucket, {})
+            for field in fields:
+                counts[field] = counts.get(field, 0) + 1
+
+            totals = {}
+            for counts in self._buckets.values():
+                for field, value in counts.items():
+                    totals[field] = totals.get(field, 0) + value
+        return totals
+
+    def _trip(self):
+        self._opened_until = time.time() + self.pause
+
+    def is_open(self):
+        return self._opened_until > time.time()
+
+    def allow(self):
+        return not self.is_open()
+
+    def record(self, latency, failed=False):
+        """
+        Records the outcome of a call. Returns True if this call tripped the breaker
+        """
+        fields = ['calls']
+        if failed:
+            fields.append('errors')
+        elif latency >= self.slow:
+            fields.append('slow')
+
+        totals = self._count(fields, time.time())
+        calls = totals.get('calls', 0)
+        bad = totals.get('errors', 0) + totals.get('slow', 0)
+
+        if calls >= self.min_calls and float(bad) / calls >= self.threshold and not self.is_open():
+            self._trip()
+            return True
+        return False
+
+    def call(self, func, *args, **kwargs):
+        """ Calls ``func`` if the breaker is closed, recording how it went """
+        if not self.allow():
+            raise CircuitOpen('Calls are paused after too many errors or slow responses')
+
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record(time.time() - start, failed=True)
+            raise
+
+        self.record(time.time() - start)
+        return result
+
+
+class RedisCircuitBreaker(CircuitBreaker):
+    """ A CircuitBreaker shared by every process using the same redis key """
+
+    def __init__(self, redis, key, **kwargs):
+        super(RedisCircuitBreaker, self).__init__(**kwargs)
+        self.redis = redis
+        self.key = key
+
+    def _count(self, fields, now):
+        bucket = self._bucket(now)
+        current = '%s:%s' % (self.key, bucket)
+        last = '%s:%s' % (self.key, bucket - 1)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for field in fields:
+            pipe.hincrby(current, field, 1)
+        pipe.expire(current, self.window * 2)
+        pipe.hgetall(current)
+        pipe.hgetall(last)
+        results = pipe.execute()
+
+        totals = {}
+        for counts in results[-2:]:
+            for field, value in (counts or {}).items():
+                totals[field] = totals.get(field, 0) + int(value)
+        return totals
+
+    def _trip(self):
+        self.redis.setex('%s:open' % self.key, 1, self.pause)
+
+    def is_open(self):
+        return bool(self.redis.exists('%s:open' % self.key))
@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 from flask import (flash,
+                   jsonify,
                    make_response,
                    redirect,
                    render_template,
@@ -49,11 +50,27 @@ def view_card(pk_hash):
         'title': 'Breeze Card %s' % card.number_masked,
         'description': 'Manage MARTA Breeze Card ending in %s' % card.last_four,
         'card': card,
-        'reminder_log': reminder_log
+        'reminder_log': reminder_log,
+        'refreshing': card.is_refreshing
     }
     return render_template('user/cards/view.html', **context)
 
 
+@fresh_login_required
+@nocache
+def card_status(pk_hash):
+    """ Polled by the card page while a refresh is pending """
+    card = BreezeCard.objects.only('id', 'has_data', 'last_loaded').get_or_404(pk_hash=pk_hash,
+                                                                            owner=current_user._get_current_object())
+    data = {
+        'refreshing': card.is_refreshing,
+        'has_data': card.has_data,
+        'last_loaded': card.last_loaded.strftime('%m/%d/%Y %I:%M %p') if card.last_loaded else None
+    }
+
+    return jsonify(data)
+
+
 @fresh_login_required
 def card_ical(pk_hash):
     from icalendar import Calendar, Event
@@ -139,8 +156,9 @@ def reload_card(pk_hash):
     if app.config.get('ALLOW_USER_REFRESH', False):
         if not app.config['REFRESH_LIMITING'] or (app.config['REFRESH_LIMITING'] and
                 card.last_loaded + app.config['REFRESH_INTERVAL'] <= datetime.now()):
-            card.pull_data()
-            flash('Card information updated successfully', 'success')
+            # The pull happens in the background. The card page polls until it's done
+            card.request_refresh()
+            flash('Your card is being updated. This page will refresh when it is done', 'info')
         else:
             flash('Card information cannot be refreshed until after %s' % 
                     (card.last_loaded + app.config['REFRESH_INTERVAL']).strftime('%m/%d/%Y %I:%M %p'))
@@ -188,5 +206,6 @@ app.add_url_rule('/cards/', 'user.cards', cards)
 app.add_url_rule('/cards/view/<pk_hash>', 'user.cards.view', view_card)
 app.add_url_rule('/cards/ical/<pk_hash>', 'user.cards.ical', card_ical)
 app.add_url_rule('/cards/reload/<pk_hash>', 'user.cards.reload', reload_card, methods=['GET', 'POST'])
+app.add_url_rule('/cards/status/<pk_hash>.json', 'user.cards.status', card_status)
 app.add_url_rule('/cards/add/', 'user.cards.add', add_card, methods=['GET', 'POST'])
 app.add_url_rule('/cards/delete/<pk_hash>', 'user.cards.delete', delete_card)
@@ -1,7 +1,5 @@
 import json
 
-from datetime import datetime, timedelta
-
 from flask import (flash,
                    make_response,
                    render_template,
@@ -13,7 +11,7 @@ from breezeminder.models.marta import (Route,
                                        Schedule,
                                        Stop,
                                        ScheduledStop,
-                                       Bus)
+                                       live_buses)
 from breezeminder.util.views import same_origin, nocache
 
 
@@ -51,16 +49,18 @@ def route_details(route_id):
 
 @same_origin
 def route_realtime(route_id):
-    # Only get "recent" buses
-    current = datetime.now() - timedelta(hours=1)
-    qs = Bus.objects.filter(route=route_id,
-                            status_time__gte=current,
-                            is_stale=False)
-    data = [bus.to_json() for bus in qs]
+    # Served as built by the realtime task. Unchanged since the last poll is a 304
+    version, data = live_buses.snapshot(route_id)
+    etag = '%s-%s' % (route_id, version or 0)
 
-    resp = make_response(json.dumps(data))
+    if request.if_none_match.contains(etag):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(data)
+        resp.headers['Content-Type'] = 'application/json'
+
+    resp.set_etag(etag)
     resp.cache_control.no_cache = True
-    resp.headers['Content-Type'] = 'application/json'
 
     return resp
 
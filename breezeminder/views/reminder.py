@@ -88,7 +88,7 @@ def edit_reminder(pk_hash):
 
                 # We need to check for new reminders only if changed
                 if was_changed:
-                    reminder.check_all_cards(force=True)
+                    reminder.queue_check_all_cards()
 
                 flash('Reminder saved successfully', 'success')
             except ReminderType.DoesNotExist:
@@ -125,7 +125,7 @@ def add_reminder():
                 reminder.save()
 
                 # We need to check for new reminders
-                reminder.check_all_cards(force=True)
+                reminder.queue_check_all_cards()
 
                 flash('Reminder created successfully', 'success')
             except ReminderType.DoesNotExist: